@@ -15,15 +15,21 @@ from flask import (
 )
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from sdk.cloudsaver import CloudSaver
 from sdk.pansou import PanSou
-from datetime import timedelta
+from datetime import datetime, timedelta
 import subprocess
 import requests
 import hashlib
+import heapq
+import copy
 import logging
 import traceback
+import threading
+import time
+import queue
 import base64
 import sys
 import os
@@ -31,7 +37,18 @@ import re
 
 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, parent_dir)
-from quark_auto_save import Quark, Config, MagicRename
+from quark_auto_save import (
+    Quark,
+    Config,
+    MagicRename,
+    FileNameIndex,
+    PathCache,
+    RequestLimiter,
+    METRICS,
+    Metrics,
+    run_in_process,
+    task_account_index,
+)
 
 print(
     r"""
@@ -74,9 +91,29 @@ DEBUG = os.environ.get("DEBUG", "false").lower() == "true"
 HOST = os.environ.get("HOST", "0.0.0.0")
 PORT = os.environ.get("PORT", 5005)
 TASK_TIMEOUT = int(os.environ.get("TASK_TIMEOUT", 1800))
+# 运行方式：subprocess 每次运行独立子进程；inprocess 在 WebUI 进程内运行，复用账号、插件与缓存
+RUN_MODE = os.environ.get("RUN_MODE", "subprocess").lower()
+# 每个账号同时运行的批次数
+TASK_CONCURRENCY = int(os.environ.get("TASK_CONCURRENCY", 1))
 
 config_data = {}
 task_plugins_config_default = {}
+quark_accounts = {}
+# 配置缓存：文件修改时间与大小未变时沿用内存中的配置，ETag 为文件内容摘要
+config_stat = None
+config_etag = ""
+config_lock = threading.Lock()
+# 最近几个版本的配置：ETag → 配置，页面保存时以其加载的版本为基准合并
+config_snapshots = {}
+CONFIG_SNAPSHOTS = 10
+# 独立计划任务的优先队列：(下次运行时间, 任务序号, 触发器)
+task_queue = []
+task_queue_lock = threading.Lock()
+# 账号 → 已到期待运行的任务序号
+pending_tasks = {}
+# 账号 → 运行名额
+account_slots = {}
+task_executor = ThreadPoolExecutor(max_workers=4)
 
 app = Flask(__name__)
 app.config["APP_VERSION"] = get_app_ver()
@@ -113,6 +150,72 @@ def get_login_token():
     return gen_md5(f"token{username}{password}+-*/")[8:24]
 
 
+def get_quark(cookie=""):
+    """按 cookie 复用账号实例，共享连接池"""
+    if cookie not in quark_accounts:
+        account = Quark(cookie)
+        # 与脚本共用路径 fid 缓存
+        account.path_cache = PathCache.from_config(
+            CONFIG_PATH, config_data.get("path_cache")
+        )
+        quark_accounts[cookie] = account
+    account = quark_accounts[cookie]
+    account.limiter = RequestLimiter.from_config(
+        config_data.get("rate_limit"), account.limiter
+    )
+    return account
+
+
+def schedule_of(data):
+    return (
+        data.get("crontab"),
+        [
+            (task.get("crontab"), task.get("interval"))
+            for task in data.get("tasklist", [])
+        ],
+    )
+
+
+def refresh_config():
+    """配置文件被脚本运行等写回后重新读取，返回是否有变化"""
+    global config_data, config_stat, config_etag
+    try:
+        stat = os.stat(CONFIG_PATH)
+    except FileNotFoundError:
+        return False
+    file_stat = (stat.st_mtime_ns, stat.st_size)
+    with config_lock:
+        if file_stat == config_stat:
+            return False
+        with open(CONFIG_PATH, "rb") as f:
+            content = f.read()
+        try:
+            data = json.loads(content)
+        except ValueError:
+            # 其他程序写入中，下次再读取
+            return False
+        Config.breaking_change_update(data)
+        # 管理账号以启动时的环境变量为准
+        data["webui"] = config_data.get("webui") or data.get("webui", {})
+        # 运行计划变化时重载调度，首次读取由启动流程加载
+        reschedule = config_stat is not None and (
+            schedule_of(data) != schedule_of(config_data)
+        )
+        config_data, config_stat = data, file_stat
+        config_etag = gen_md5(content.decode("utf-8"))
+        config_snapshots[config_etag] = copy.deepcopy(data)
+        while len(config_snapshots) > CONFIG_SNAPSHOTS:
+            del config_snapshots[next(iter(config_snapshots))]
+    if reschedule:
+        reload_tasks()
+    return True
+
+
+@app.before_request
+def before_request():
+    refresh_config()
+
+
 def is_login():
     login_token = get_login_token()
     if session.get("token") == login_token or request.args.get("token") == login_token:
@@ -176,11 +279,18 @@ def index():
 def get_data():
     if not is_login():
         return jsonify({"success": False, "message": "未登录"})
-    data = Config.read_json(CONFIG_PATH)
-    del data["webui"]
-    data["api_token"] = get_login_token()
-    data["task_plugins_config_default"] = task_plugins_config_default
-    return jsonify({"success": True, "data": data})
+    # 配置未变化时返回 304，页面轮询不再重复传输；保存时以 If-Match 带回
+    etag = config_etag
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        data = {key: value for key, value in config_data.items() if key != "webui"}
+        data["api_token"] = get_login_token()
+        data["task_plugins_config_default"] = task_plugins_config_default
+        response = jsonify({"success": True, "data": data})
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 
 # 更新数据
@@ -192,10 +302,26 @@ def update():
     # 使用允许列表防止批量赋值攻击
     allowed_keys = ["cookie", "crontab", "push_config", "tasklist",
                     "magic_regex", "plugins", "source"]
+    # 以页面加载的配置版本为基准合并，保留此后脚本运行等写回的改动
+    # 未带 If-Match 的客户端（如 qas_client）以当前配置为基准
+    config_base = config_data
+    if etags := request.if_match.as_set():
+        config_base = next(
+            (config_snapshots[etag] for etag in etags if etag in config_snapshots),
+            None,
+        )
+    if config_base is None:
+        return (
+            jsonify(
+                {"success": False, "message": "配置已在别处更新，请刷新页面后重试"}
+            ),
+            409,
+        )
+    new_config = copy.deepcopy(config_base)
     for key, value in request.json.items():
         if key in allowed_keys:
-            config_data.update({key: value})
-    Config.write_json(CONFIG_PATH, config_data)
+            new_config.update({key: value})
+    config_data = Config.patch_json(CONFIG_PATH, config_base, new_config)
     # 重新加载任务
     if reload_tasks():
         logging.info(f">>> 配置更新成功")
@@ -205,6 +331,68 @@ def update():
         return jsonify({"success": False, "message": "配置更新失败"})
 
 
+class LineQueue:
+    """收集进程内运行的输出，供逐行读取"""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def write(self, text):
+        self.queue.put(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+# 超时后停止等待、但仍在运行的进程内运行线程
+inprocess_stuck = None
+
+
+def run_inprocess_lines(tasklist=None, task_indexes=None, sign=True):
+    """在后台线程中进程内运行，逐行产出日志；超过 TASK_TIMEOUT 停止等待"""
+    global inprocess_stuck
+    # 线程无法强制终止，超时的运行结束前跳过新的运行，避免等待运行锁的线程不断累积
+    if inprocess_stuck and inprocess_stuck.is_alive():
+        yield f"上次运行超时(>{TASK_TIMEOUT}s)后仍未结束，跳过本次运行\n"
+        return
+    output = LineQueue()
+
+    def target():
+        try:
+            run_in_process(
+                CONFIG_PATH,
+                tasklist or [],
+                output,
+                task_indexes,
+                sign,
+                timeout=TASK_TIMEOUT,
+            )
+        except Exception:
+            output.write(traceback.format_exc())
+        finally:
+            output.queue.put(None)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + TASK_TIMEOUT
+    pending = ""
+    while True:
+        try:
+            text = output.queue.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            inprocess_stuck = thread
+            yield f"任务执行超时(>{TASK_TIMEOUT}s)，停止等待\n"
+            return
+        if text is None:
+            break
+        *lines, pending = (pending + text).split("\n")
+        for line in lines:
+            yield f"{line}\n"
+    if pending:
+        yield f"{pending}\n"
+
+
 # 处理运行脚本请求
 @app.route("/run_script_now", methods=["POST"])
 def run_script_now():
@@ -230,6 +418,13 @@ def run_script_now():
             )
         if tasklist:
             process_env["TASKLIST"] = json.dumps(tasklist, ensure_ascii=False)
+        # 推送测试使用独立的环境变量，始终以子进程运行
+        if RUN_MODE == "inprocess" and not request.json.get("quark_test"):
+            for line in run_inprocess_lines(tasklist):
+                logging.info(line.strip())
+                yield f"data: {line}\n\n"
+            yield "data: [DONE]\n\n"
+            return
         process = subprocess.Popen(
             command,
             stdout=subprocess.PIPE,
@@ -278,9 +473,15 @@ def get_task_suggestions():
             )
             search = cs.auto_login_search(query)
             if search.get("success"):
-                if search.get("new_token"):
-                    cs_data["token"] = search.get("new_token")
-                    Config.write_json(CONFIG_PATH, config_data)
+                if new_token := search.get("new_token"):
+                    cs_data["token"] = new_token
+
+                    # 只更新文件中的 token，不写回内存中可能已过时的其他配置
+                    def update_token(data):
+                        source = data.setdefault("source", {})
+                        source.setdefault("cloudsaver", {})["token"] = new_token
+
+                    Config.update_json(CONFIG_PATH, update_token)
                 search_results = cs.clean_search_results(search.get("data"))
                 return search_results
         return []
@@ -324,7 +525,7 @@ def get_share_detail():
         return jsonify({"success": False, "message": "未登录"})
     shareurl = request.json.get("shareurl", "")
     stoken = request.json.get("stoken", "")
-    account = Quark()
+    account = get_quark()
     pwd_id, passcode, pdir_fid, paths = account.extract_url(shareurl)
     if not stoken:
         get_stoken = account.get_stoken(pwd_id, passcode)
@@ -334,9 +535,25 @@ def get_share_detail():
             return jsonify(
                 {"success": False, "data": {"error": get_stoken.get("message")}}
             )
-    share_detail = account.get_detail(
-        pwd_id, stoken, pdir_fid, _fetch_share=1, fetch_share_full_path=1
-    )
+    task = request.json.get("task", {})
+
+    def get_savepath_list():
+        if not task:
+            return []
+        savepath_account = get_quark(config_data["cookie"][0])
+        savepath = task.get("savepath", "")
+        fid = savepath_account.resolve_fids([savepath]).get(savepath)
+        if not fid:
+            return []
+        return savepath_account.ls_dir(fid)["data"]["list"]
+
+    # 分享详情与保存目录列表并行获取
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        savepath_future = executor.submit(get_savepath_list)
+        share_detail = account.get_detail(
+            pwd_id, stoken, pdir_fid, _fetch_share=1, fetch_share_full_path=1
+        )
+        dir_file_list = savepath_future.result()
 
     if share_detail.get("code") != 0:
         return jsonify(
@@ -362,50 +579,32 @@ def get_share_detail():
 
     # 正则处理预览
     def preview_regex(data):
-        task = request.json.get("task", {})
         magic_regex = request.json.get("magic_regex", {})
         mr = MagicRename(magic_regex)
         mr.set_taskname(task.get("taskname", ""))
-        account = Quark(config_data["cookie"][0])
-        get_fids = account.get_fids([task.get("savepath", "")])
-        if get_fids:
-            dir_file_list = account.ls_dir(get_fids[0]["fid"])["data"]["list"]
-            dir_filename_list = [dir_file["file_name"] for dir_file in dir_file_list]
-        else:
-            dir_file_list = []
-            dir_filename_list = []
+        dir_filename_index = FileNameIndex(
+            [dir_file["file_name"] for dir_file in dir_file_list]
+        )
 
         pattern, replace = mr.magic_regex_conv(
             task.get("pattern", ""), task.get("replace", "")
         )
-        for share_file in data["list"]:
-            search_pattern = (
-                task["update_subdir"]
-                if share_file["dir"] and task.get("update_subdir")
-                else pattern
-            )
-            if re.search(search_pattern, share_file["file_name"]):
-                # 文件名重命名，目录不重命名
-                file_name_re = (
-                    share_file["file_name"]
-                    if share_file["dir"]
-                    else mr.sub(pattern, replace, share_file["file_name"])
-                )
-                if file_name_saved := mr.is_exists(
-                    file_name_re,
-                    dir_filename_list,
-                    (task.get("ignore_extension") and not share_file["dir"]),
-                ):
-                    share_file["file_name_saved"] = file_name_saved
-                else:
-                    share_file["file_name_re"] = file_name_re
+        # 与转存相同的匹配、重命名与已存在判断
+        mr.plan_file_list(
+            data["list"],
+            pattern,
+            replace,
+            dir_filename_index,
+            task.get("update_subdir", ""),
+            task.get("ignore_extension"),
+        )
 
         # 文件列表排序
         if re.search(r"\{I+\}", replace):
             mr.set_dir_file_list(dir_file_list, replace)
             mr.sort_file_list(data["list"])
 
-    if request.json.get("task"):
+    if task:
         preview_regex(data)
 
     return jsonify({"success": True, "data": data})
@@ -426,7 +625,7 @@ def get_savepath_detail():
 
 
 def _get_file_list(fid: str = None, path: str = None):
-    account = Quark(config_data["cookie"][0])
+    account = get_quark(config_data["cookie"][0])
     paths = []
     if path and not fid:
         path = re.sub(r"/+", "/", path)
@@ -441,10 +640,15 @@ def _get_file_list(fid: str = None, path: str = None):
             for dir_name in dir_names:
                 current_path += "/" + dir_name
                 path_fids.append(current_path)
-            if get_fids := account.get_fids(path_fids):
-                fid = get_fids[-1]["fid"]
+            path_fid_map = account.resolve_fids(path_fids)
+            if get_fids := [
+                path_fid_map[path_fid]
+                for path_fid in path_fids
+                if path_fid in path_fid_map
+            ]:
+                fid = get_fids[-1]
                 paths = [
-                    {"fid": get_fid["fid"], "name": dir_name}
+                    {"fid": get_fid, "name": dir_name}
                     for get_fid, dir_name in zip(get_fids, dir_names)
                 ]
             else:
@@ -478,7 +682,7 @@ def delete_file():
     try:
         fid = request.json.get("fid") or _path_to_fid(request.json.get("path"))
         if fid:
-            account = Quark(config_data["cookie"][0])
+            account = get_quark(config_data["cookie"][0])
             response = account.delete([fid])
             response["success"] = response["code"] == 0
             return jsonify(response)
@@ -496,7 +700,7 @@ def rename_file():
         fid = request.json.get("fid") or _path_to_fid(request.json.get("path"))
         file_name = request.json.get("file_name")
         if fid and file_name:
-            account = Quark(config_data["cookie"][0])
+            account = get_quark(config_data["cookie"][0])
             response = account.rename(fid, file_name)
             response["success"] = response["code"] == 0
             return jsonify(response)
@@ -506,6 +710,30 @@ def rename_file():
         return jsonify({"success": False, "message": str(e)})
 
 
+# 接口请求统计，默认 Prometheus 文本格式，format=json 时返回 JSON
+@app.route("/metrics")
+def get_metrics():
+    if not is_login():
+        return jsonify({"success": False, "message": "未登录"})
+    # webui: 本进程累计（含进程内运行），last_run: 最近一次脚本运行
+    data = {"webui": METRICS.summary()}
+    metrics_path = os.path.join(
+        os.path.dirname(os.path.abspath(CONFIG_PATH)), "metrics.json"
+    )
+    if os.path.exists(metrics_path):
+        try:
+            data["last_run"] = Config.read_json(metrics_path)
+        except Exception as e:
+            logging.warning(f">>> 读取接口统计失败: {e}")
+    if request.args.get("format") == "json":
+        return jsonify({"success": True, "data": data})
+    text = "".join(
+        Metrics.to_prometheus(summary, {"source": source})
+        for source, summary in data.items()
+    )
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
 # 添加任务接口
 @app.route("/api/add_task", methods=["POST"])
 def add_task():
@@ -526,9 +754,11 @@ def add_task():
             )
     if not request_data.get("addition"):
         request_data["addition"] = task_plugins_config_default
-    # 添加任务
-    config_data["tasklist"].append(request_data)
-    Config.write_json(CONFIG_PATH, config_data)
+    # 添加任务：追加到配置文件当前的任务列表，不覆盖脚本运行期间写回的改动
+    Config.update_json(
+        CONFIG_PATH, lambda data: data.setdefault("tasklist", []).append(request_data)
+    )
+    refresh_config()
     logging.info(f">>> 通过API添加任务: {request_data['taskname']}")
     return jsonify(
         {"success": True, "code": 0, "message": "任务添加成功", "data": request_data}
@@ -536,12 +766,28 @@ def add_task():
 
 
 # 定时任务执行的函数
-def run_python(args):
+def run_python(args, task_indexes=None, sign=True):
     logging.info(f">>> 定时运行任务")
+    if RUN_MODE == "inprocess":
+        try:
+            for line in run_inprocess_lines(task_indexes=task_indexes, sign=sign):
+                if line.strip():
+                    logging.info(line.rstrip("\n"))
+            logging.info(f">>> 任务执行完成")
+        except Exception as e:
+            logging.error(f">>> 任务执行异常: {str(e)}")
+            logging.error(traceback.format_exc())
+        return
+    process_env = os.environ.copy()
+    if task_indexes is not None:
+        process_env["RUN_TASKS"] = ",".join(map(str, task_indexes))
+    if not sign:
+        process_env["RUN_SIGN"] = "false"
     try:
         result = subprocess.run(
             f"{PYTHON_PATH} {args}",
             shell=True,
+            env=process_env,
             timeout=TASK_TIMEOUT,
             capture_output=True,
             text=True,
@@ -570,6 +816,104 @@ def run_python(args):
         logging.debug(f">>> run_python 函数执行完成")
 
 
+def task_trigger(task):
+    """任务独立计划：crontab 定时规则或 interval 间隔分钟，均未设置则随全局定时运行"""
+    if task.get("crontab"):
+        return CronTrigger.from_crontab(task["crontab"])
+    if task.get("interval"):
+        return IntervalTrigger(minutes=int(task["interval"]))
+    return None
+
+
+def valid_trigger(task):
+    try:
+        return task_trigger(task)
+    except ValueError as e:
+        logging.error(f"任务 {task.get('taskname')} 运行计划无效: {e}")
+        return None
+
+
+def global_task_indexes():
+    """随全局定时运行的任务序号，均未设置独立计划时为 None，即运行全部任务"""
+    tasklist = config_data.get("tasklist", [])
+    indexes = [i for i, task in enumerate(tasklist) if valid_trigger(task) is None]
+    return None if len(indexes) == len(tasklist) else indexes
+
+
+def task_account(task):
+    """任务使用的账号序号（从0开始），与脚本 shard_tasks 的规则一致
+
+    任务的 account 字段（从1开始）指定账号，未指定或无效时为首个账号。
+    """
+    index = task_account_index(task)
+    cookies = Config.get_cookies(config_data.get("cookie")) or []
+    if 0 < index <= len(cookies):
+        return index - 1
+    return 0
+
+
+def account_slot(account):
+    return account_slots.setdefault(account, threading.Semaphore(TASK_CONCURRENCY))
+
+
+def run_global(args):
+    """全局定时运行：签到并运行未设置独立计划的任务，任务序号在运行时计算"""
+    refresh_config()
+    slot = account_slot(0)
+    with slot:
+        run_python(args, global_task_indexes())
+    dispatch_tasks()
+
+
+def run_task_batch(account, task_indexes):
+    try:
+        logging.info(f">>> 按计划运行任务 {[i + 1 for i in task_indexes]}")
+        run_python(f"{SCRIPT_PATH} {CONFIG_PATH}", task_indexes, sign=False)
+    finally:
+        account_slot(account).release()
+        dispatch_tasks()
+
+
+def dispatch_tasks():
+    """取出已到期的任务，按账号合并为批次，账号有空闲名额时运行"""
+    refresh_config()
+    tasklist = config_data.get("tasklist", [])
+    batches = []
+    with task_queue_lock:
+        while task_queue and task_queue[0][0] <= datetime.now(task_queue[0][0].tzinfo):
+            _, index, trigger = heapq.heappop(task_queue)
+            # 错过的多次触发合并为一次，从当前时间计算下次运行
+            now = datetime.now(trigger.timezone) + timedelta(seconds=1)
+            if next_time := trigger.get_next_fire_time(None, now):
+                heapq.heappush(task_queue, (next_time, index, trigger))
+            if index < len(tasklist):
+                pending_tasks.setdefault(task_account(tasklist[index]), set()).add(
+                    index
+                )
+        for account in list(pending_tasks):
+            if pending_tasks[account]:
+                if account_slot(account).acquire(blocking=False):
+                    batches.append((account, sorted(pending_tasks.pop(account))))
+    for account, task_indexes in batches:
+        task_executor.submit(run_task_batch, account, task_indexes)
+
+
+def reload_task_queue():
+    """按任务的独立计划重建调度队列"""
+    with task_queue_lock:
+        task_queue.clear()
+        pending_tasks.clear()
+        for index, task in enumerate(config_data.get("tasklist", [])):
+            trigger = valid_trigger(task)
+            if trigger and (
+                next_time := trigger.get_next_fire_time(
+                    None, datetime.now(trigger.timezone)
+                )
+            ):
+                task_queue.append((next_time, index, trigger))
+        heapq.heapify(task_queue)
+
+
 # 重新加载任务
 def reload_tasks():
     # 读取定时规则
@@ -578,8 +922,10 @@ def reload_tasks():
             scheduler.pause()  # 暂停调度器
         trigger = CronTrigger.from_crontab(crontab)
         scheduler.remove_all_jobs()
+        # 设置了独立计划的任务由调度队列运行，全局定时只运行其余任务
+        reload_task_queue()
         scheduler.add_job(
-            run_python,
+            run_global,
             trigger=trigger,
             args=[f"{SCRIPT_PATH} {CONFIG_PATH}"],
             id=SCRIPT_PATH,
@@ -588,6 +934,15 @@ def reload_tasks():
             misfire_grace_time=300,  # 错过任务的宽限期(秒)，超过则跳过
             replace_existing=True,  # 替换已存在的同ID任务
         )
+        if task_queue:
+            scheduler.add_job(
+                dispatch_tasks,
+                trigger=IntervalTrigger(seconds=30),
+                id="dispatch_tasks",
+                max_instances=1,
+                coalesce=True,
+                replace_existing=True,
+            )
         if scheduler.state == 0:
             scheduler.start()
         elif scheduler.state == 2:
@@ -596,6 +951,8 @@ def reload_tasks():
         logging.info(">>> 重载调度器")
         logging.info(f"调度状态: {scheduler_state_map[scheduler.state]}")
         logging.info(f"定时规则: {crontab}")
+        if task_queue:
+            logging.info(f"独立计划: {len(task_queue)} 个任务")
         logging.info(f"现有任务: {scheduler.get_jobs()}")
         return True
     else:
@@ -644,6 +1001,7 @@ def init():
 
     # 更新配置
     Config.write_json(CONFIG_PATH, config_data)
+    refresh_config()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+MagicRename.sort_file_list 基准测试
+
+用法: python bench_sort_file_list.py [文件数] [重复次数]
+结果同时写入 bench_output.txt
+"""
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from quark_auto_save import MagicRename
+
+
+def make_file_list(count, seed=1):
+    """随机文件列表：约2%为目录，目录已有文件为随机序号，占十分之一"""
+    rnd = random.Random(seed)
+    file_list = [
+        {
+            "file_name_re": f"剧{rnd.choice('上中下一二三')}.E{{IIIII}}.S01E{k:05d}.mp4",
+            "updated_at": rnd.randint(1, 9),
+            "dir": rnd.random() < 0.02,
+        }
+        for k in rnd.sample(range(count * 2), count)
+    ]
+    dir_filename_dict = {
+        rnd.randint(1, count): f"已有文件{j}" for j in range(count // 10)
+    }
+    return file_list, dir_filename_dict
+
+
+def make_contiguous_file_list(count, seed=1):
+    """追更场景：目录已有第 1..count 集，新文件排在前面，序号均需顺延到已有序号之后"""
+    rnd = random.Random(seed)
+    file_list = [
+        {
+            "file_name_re": f"剧.E{{IIIII}}.{k:05d}.mp4",
+            "updated_at": rnd.randint(1, 9),
+            "dir": False,
+        }
+        for k in range(count)
+    ]
+    dir_filename_dict = {k: f"剧.S01E{k:05d}.mp4" for k in range(1, count + 1)}
+    return file_list, dir_filename_dict
+
+
+def bench(count=10000, repeat=5):
+    results = []
+    for case, make in (
+        ("随机序号", make_file_list),
+        ("连续已有序号", make_contiguous_file_list),
+    ):
+        file_list, dir_filename_dict = make(count)
+
+        def run():
+            # sort_file_list 会改写文件名与已有文件字典，每次使用副本
+            MagicRename().sort_file_list(
+                [dict(f) for f in file_list], dict(dir_filename_dict)
+            )
+
+        times = timeit.repeat(run, number=1, repeat=repeat)
+        results.append(
+            f"sort_file_list {case} {count} 个文件, 重复 {repeat} 次: "
+            f"最快 {min(times):.3f}s, 平均 {sum(times) / len(times):.3f}s"
+        )
+    return "\n".join(results)
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    result = bench(*args)
+    print(result)
+    with open("bench_output.txt", "a", encoding="utf-8") as f:
+        f.write(f"{result}\n")
@@ -93,8 +93,15 @@ class Auto_unarchive:
                             break
                     time.sleep(1)
 
+                # 批量轮询，任一任务结束即返回以便提交后续解压
+                q_results = account.query_tasks(
+                    [p_task["task_id"] for p_task in active_tasks],
+                    first_completed=True,
+                )
                 for p_task in active_tasks[:]:
-                    q_res = account.query_task(p_task["task_id"])
+                    q_res = q_results.get(p_task["task_id"])
+                    if q_res is None:
+                        continue
 
                     if q_res.get("code") == 0:
                         print(f"  ✅ 解压完成: {p_task['zip_name']}")
@@ -113,7 +120,10 @@ class Auto_unarchive:
                         print(f"  ⚠️ 任务异常: {p_task['zip_name']} {q_res.get('message','')}")
                         active_tasks.remove(p_task)
 
-                if active_tasks:
+                # 仅有暂时性异常时稍后重试
+                if active_tasks and all(
+                    q_res.get("code") == 1 for q_res in q_results.values()
+                ):
                     time.sleep(5)
 
             if all_move_fids:
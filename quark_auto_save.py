@@ -7,19 +7,33 @@
 new Env('夸克自动追更');
 0 8,18,20 * * * quark_auto_save.py
 """
+import io
 import os
 import re
 import sys
+import copy
 import json
+import math
 import time
 import random
+import shutil
+import sqlite3
+import hashlib
+import contextlib
+import functools
+import threading
 import platform
 import requests
 import importlib
 import traceback
 import urllib.parse
 from datetime import datetime
+from collections import deque
 from natsort import natsorted
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # 兼容青龙
 try:
@@ -29,18 +43,41 @@ except:
     os.system("pip3 install treelib &> /dev/null")
     from treelib import Tree
 
+# 配置文件跨进程锁，Windows 下仅进程内加锁
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 CONFIG_DATA = {}
 NOTIFYS = []
 GH_PROXY = os.environ.get("GH_PROXY", "https://ghproxy.net/")
+# 并发任务的线程上下文：缓冲输出与通知
+TASK_LOCAL = threading.local()
+# 进程内运行（WebUI 常驻进程）复用的账号实例与插件，None 为每次新建
+WARM_ACCOUNTS = None
+WARM_PLUGINS = None
+RUN_LOCK = threading.Lock()
+# 插件有状态，多账号并行转存时依次调用
+PLUGIN_LOCK = threading.RLock()
+CONFIG_LOCK = threading.Lock()
+# 通知模块载入时由环境变量得到的推送设置
+NOTIFY_ENV_CONFIG = None
 
 
 # 发送通知消息
 def send_ql_notify(title, body):
+    global NOTIFY_ENV_CONFIG
     try:
         # 导入通知模块
         import notify
 
+        # 常驻进程中多次运行共用通知模块，每次从环境变量设置开始，已移除的渠道不再推送
+        if NOTIFY_ENV_CONFIG is None:
+            NOTIFY_ENV_CONFIG = dict(notify.push_config)
+        notify.push_config.clear()
+        notify.push_config.update(NOTIFY_ENV_CONFIG)
         # 如未配置 push_config 则使用青龙环境通知设置
         if CONFIG_DATA.get("push_config"):
             notify.push_config.update(CONFIG_DATA["push_config"])
@@ -54,11 +91,53 @@ def send_ql_notify(title, body):
 # 添加消息
 def add_notify(text):
     global NOTIFYS
-    NOTIFYS.append(text)
+    notifys = getattr(TASK_LOCAL, "notifys", None)
+    (NOTIFYS if notifys is None else notifys).append(text)
     print("📢", text)
     return text
 
 
+def extend_notifys(notifys):
+    """合并缓冲的通知，处于外层缓冲中时并入外层"""
+    parent = getattr(TASK_LOCAL, "notifys", None)
+    (NOTIFYS if parent is None else parent).extend(notifys)
+
+
+class TaskOutput:
+    """按线程缓冲标准输出，使并发任务的日志按任务顺序输出"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        buffer = getattr(TASK_LOCAL, "buffer", None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self):
+        if getattr(TASK_LOCAL, "buffer", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_captured(func, *args, **kwargs):
+    """在当前线程中执行并缓冲输出与通知，返回 (结果, 异常, 输出, 通知)"""
+    parent = getattr(TASK_LOCAL, "buffer", None), getattr(TASK_LOCAL, "notifys", None)
+    TASK_LOCAL.buffer = io.StringIO()
+    TASK_LOCAL.notifys = []
+    result, error = None, None
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        error = e
+        traceback.print_exc(file=TASK_LOCAL.buffer)
+    finally:
+        output, notifys = TASK_LOCAL.buffer.getvalue(), TASK_LOCAL.notifys
+        TASK_LOCAL.buffer, TASK_LOCAL.notifys = parent
+    return result, error, output, notifys
+
+
 class Config:
     # 下载配置
     def download_file(url, save_path):
@@ -78,8 +157,133 @@ class Config:
 
     # 将数据写入 JSON 文件
     def write_json(config_path, data):
-        with open(config_path, "w", encoding="utf-8") as f:
+        with Config.lock(config_path):
+            Config.replace_json(config_path, data)
+
+    # 配置文件锁：进程内线程锁，fcntl 可用时另加跨进程文件锁
+    @contextlib.contextmanager
+    def lock(config_path):
+        with CONFIG_LOCK:
+            if fcntl is None:
+                yield
+                return
+            with open(f"{config_path}.lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # 先写临时文件再替换，写入中断或同时读取时不会得到不完整的配置
+    def replace_json(config_path, data):
+        tmp_path = f"{config_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, sort_keys=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            if os.path.exists(config_path):
+                shutil.copymode(config_path, tmp_path)
+            os.replace(tmp_path, config_path)
+        except OSError:
+            # 配置文件单独挂载时无法替换，改为原地写入
+            os.remove(tmp_path)
+            with open(config_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, sort_keys=False, indent=2)
+
+    # 在文件锁内读取配置文件当前内容，由 update 就地修改后写入，返回写入后的配置
+    def update_json(config_path, update):
+        with Config.lock(config_path):
+            data = Config.read_json(config_path)
+            update(data)
+            Config.replace_json(config_path, data)
+        return data
+
+    # 将 data 相对 base 的改动合并到配置文件的当前内容后写入，返回合并后的配置
+    def patch_json(config_path, base, data):
+        with Config.lock(config_path):
+            try:
+                current = Config.read_json(config_path)
+            except FileNotFoundError:
+                current = {}
+            merged = Config.merge_json(base, data, current)
+            if merged != current:
+                Config.replace_json(config_path, merged)
+        return merged
+
+    # 三方合并：data 相对 base 改动的部分覆盖 current，其余保留 current
+    def merge_json(base, data, current):
+        if data == base:
+            return current
+        if current == base:
+            return data
+        if not (
+            isinstance(base, dict)
+            and isinstance(data, dict)
+            and isinstance(current, dict)
+        ):
+            return data
+        merged = dict(current)
+        for key in base.keys() - data.keys():
+            merged.pop(key, None)
+        for key, value in data.items():
+            if key in base and key in current:
+                if key == "tasklist":
+                    merged[key] = Config.merge_tasklist(base[key], value, current[key])
+                else:
+                    merged[key] = Config.merge_json(base[key], value, current[key])
+            elif key not in base or value != base[key]:
+                merged[key] = value
+        return merged
+
+    # 任务列表按 data 的顺序合并，任务以名称、分享链接、保存路径区分，
+    # current 仅用于补充文件中新增的任务、去掉文件中已删除的任务
+    def merge_tasklist(base, data, current):
+        def match(tasklist):
+            """返回 tasklist 中各任务对应的 base 下标，无对应时为 None"""
+            base_index, counts = {}, {}
+            for i, task in enumerate(base):
+                key = RunJournal.task_key(task)
+                counts[key] = counts.get(key, 0) + 1
+                base_index[(key, counts[key])] = i
+            matched, counts = [], {}
+            for task in tasklist:
+                key = RunJournal.task_key(task)
+                counts[key] = counts.get(key, 0) + 1
+                matched.append(base_index.get((key, counts[key])))
+            # 区分字段被修改的任务按位置对应 base 任务，需至少一个区分字段未变
+            unmatched = set(range(len(base))) - set(matched)
+            for i, index in enumerate(matched):
+                if (
+                    index is None
+                    and i in unmatched
+                    and any(
+                        tasklist[i].get(field) == base[i].get(field)
+                        for field in ("taskname", "shareurl", "savepath")
+                    )
+                ):
+                    matched[i] = i
+                    unmatched.discard(i)
+            return matched
+
+        current_index = match(current)
+        current_tasks = {
+            index: task
+            for index, task in zip(current_index, current)
+            if index is not None
+        }
+        merged = []
+        for task, index in zip(data, match(data)):
+            if index is None:
+                merged.append(task)
+            elif index in current_tasks:
+                merged.append(
+                    Config.merge_json(base[index], task, current_tasks[index])
+                )
+        for i, (task, index) in enumerate(zip(current, current_index)):
+            if index is None:
+                merged.insert(min(i, len(merged)), task)
+        return merged
 
     # 读取CK
     def get_cookies(cookie_val):
@@ -145,6 +349,67 @@ class Config:
                 task["replace"] = task["replace"].replace("$TASKNAME", "{TASKNAME}")
 
 
+@functools.lru_cache(maxsize=1024)
+def re_compile(pattern):
+    """编译正则并缓存，跨任务复用"""
+    return re.compile(pattern)
+
+
+class FileNameIndex:
+    """目录文件名索引，每个目录构建一次，供 is_exists 常数时间查询
+
+    包含精确文件名集合、去扩展名集合，以及 {I+} 序号位置索引：
+    按 (序号前缀长度, 序号位数, 序号后缀长度) 记录该位置为数字的文件，
+    键为序号前的前缀与序号后等长的后缀，未命中时同样常数时间返回。
+    """
+
+    def __init__(self, filename_list):
+        self.filename_lists = {False: list(filename_list)}
+        self.filename_sets = {}
+        self.number_index = {}
+
+    def _filename_list(self, ignore_ext):
+        if ignore_ext not in self.filename_lists:
+            self.filename_lists[ignore_ext] = [
+                os.path.splitext(f)[0] for f in self.filename_lists[False]
+            ]
+        return self.filename_lists[ignore_ext]
+
+    def find(self, filename, ignore_ext=False):
+        """查找已存在的文件，{I+} 模式用I通配数字序号，返回匹配到的文件名"""
+        ignore_ext = bool(ignore_ext)
+        if ignore_ext:
+            filename = os.path.splitext(filename)[0]
+        if match := re.search(r"\{I+\}", filename):
+            magic_i = match.group()
+            if filename.count(magic_i) > 1:
+                # 多处序号，回退逐个正则匹配
+                pattern = re.escape(filename).replace(
+                    re.escape(magic_i), r"\d" * magic_i.count("I")
+                )
+                pattern = re_compile(pattern)
+                return next(
+                    (f for f in self._filename_list(ignore_ext) if pattern.match(f)),
+                    None,
+                )
+            prefix, suffix = filename[: match.start()], filename[match.end() :]
+            start, width = len(prefix), magic_i.count("I")
+            end = start + width
+            key = (ignore_ext, start, width, len(suffix))
+            if key not in self.number_index:
+                index = {}
+                for f in self._filename_list(ignore_ext):
+                    number = f[start:end]
+                    if len(number) == width and number.isdecimal():
+                        # 与逐个正则匹配一致，后缀之后可有其他字符，同键取首个文件
+                        index.setdefault((f[:start], f[end : end + len(suffix)]), f)
+                self.number_index[key] = index
+            return self.number_index[key].get((prefix, suffix))
+        if ignore_ext not in self.filename_sets:
+            self.filename_sets[ignore_ext] = set(self._filename_list(ignore_ext))
+        return filename if filename in self.filename_sets[ignore_ext] else None
+
+
 class MagicRename:
 
     magic_regex = {
@@ -206,10 +471,15 @@ class MagicRename:
         "千",
         "万",
     ]
+    # 关键字均为单字，替换结果不含关键字，可一次 translate 完成
+    priority_table = str.maketrans(
+        {keyword: f"_{i:02d}_" for i, keyword in enumerate(priority_list)}
+    )
 
     def __init__(self, magic_regex={}, magic_variable={}):
-        self.magic_regex.update(magic_regex)
-        self.magic_variable.update(magic_variable)
+        # 实例独立副本，避免并发任务间共享 {TASKNAME}、{I} 等状态
+        self.magic_regex = {**self.magic_regex, **magic_regex}
+        self.magic_variable = {**self.magic_variable, **magic_variable}
         self.dir_filename_dict = {}
 
     def set_taskname(self, taskname):
@@ -227,50 +497,69 @@ class MagicRename:
 
     def sub(self, pattern, replace, file_name):
         """魔法正则、变量替换"""
+        return self.sub_list(pattern, replace, [file_name])[0]
+
+    def _variable_column(self, key, file_names):
+        """整列提取正则类变量的值，未匹配为 None"""
+        p_list = [re_compile(p) for p in self.magic_variable[key]]
+        column = []
+        for file_name in file_names:
+            value = None
+            for p in p_list:
+                if match := p.search(file_name):
+                    # 匹配成功，替换为匹配到的值
+                    value = match.group()
+                    # 日期格式处理：补全、格式化
+                    if key == "{DATE}":
+                        value = "".join([char for char in value if char.isdigit()])
+                        value = str(datetime.now().year)[: (8 - len(value))] + value
+                    break
+            column.append(value)
+        return column
+
+    def sub_list(self, pattern, replace, file_names):
+        """批量魔法正则、变量替换，返回与 file_names 一一对应的文件名列表"""
         if not replace:
-            return file_name
-        # 预处理替换变量
-        for key, p_list in self.magic_variable.items():
-            if key in replace:
+            return list(file_names)
+        # 替换式中出现的变量，按列提取各文件的值
+        keys = [key for key in self.magic_variable if key in replace]
+        columns = {
+            key: self._variable_column(key, file_names)
+            for key in keys
+            if self.magic_variable[key] and isinstance(self.magic_variable[key], list)
+        }
+        pattern_re = re_compile(pattern) if pattern else None
+        file_names_re = []
+        for index, file_name in enumerate(file_names):
+            file_replace = replace
+            for key in keys:
+                if key not in file_replace:
+                    continue
                 # 正则类替换变量
-                if p_list and isinstance(p_list, list):
-                    for p in p_list:
-                        match = re.search(p, file_name)
-                        if match:
-                            # 匹配成功，替换为匹配到的值
-                            value = match.group()
-                            # 日期格式处理：补全、格式化
-                            if key == "{DATE}":
-                                value = "".join(
-                                    [char for char in value if char.isdigit()]
-                                )
-                                value = (
-                                    str(datetime.now().year)[: (8 - len(value))] + value
-                                )
-                            replace = replace.replace(key, value)
-                            break
+                value = columns[key][index] if key in columns else None
+                if value is not None:
+                    file_replace = file_replace.replace(key, value)
                 # 非正则类替换变量
                 if key == "{TASKNAME}":
-                    replace = replace.replace(key, self.magic_variable["{TASKNAME}"])
-                elif key == "{SXX}" and not match:
-                    replace = replace.replace(key, "S01")
+                    file_replace = file_replace.replace(
+                        key, self.magic_variable["{TASKNAME}"]
+                    )
+                elif key == "{SXX}" and value is None:
+                    file_replace = file_replace.replace(key, "S01")
                 elif key == "{I}":
                     continue
                 else:
                     # 清理未匹配的 magic_variable key
-                    replace = replace.replace(key, "")
-        if pattern and replace:
-            file_name = re.sub(pattern, replace, file_name)
-        else:
-            file_name = replace
-        return file_name
+                    file_replace = file_replace.replace(key, "")
+            if pattern_re and file_replace:
+                file_names_re.append(pattern_re.sub(file_replace, file_name))
+            else:
+                file_names_re.append(file_replace)
+        return file_names_re
 
     def _custom_sort_key(self, name):
         """自定义排序键"""
-        for i, keyword in enumerate(self.priority_list):
-            if keyword in name:
-                name = name.replace(keyword, f"_{i:02d}_")  # 替换为数字，方便排序
-        return name
+        return name.translate(self.priority_table)  # 替换为数字，方便排序
 
     def sort_file_list(self, file_list, dir_filename_dict={}):
         """文件列表统一排序，给{I+}赋值"""
@@ -287,12 +576,19 @@ class MagicRename:
         filename_list = list(set(filename_list) | set(dir_filename_dict.values()))
         filename_list = natsorted(filename_list, key=self._custom_sort_key)
         filename_index = {}
-        for name in filename_list:
-            if name in dir_filename_dict.values():
+        dir_filenames = set(dir_filename_dict.values())
+        taken = set(dir_filename_dict.keys())
+        # 列表已去重，序号即排序位置，和已占用序号冲突时顺延
+        # 上一个顺延到的序号之前均已占用，从两者较大者起查找，避免逐个跳过已有序号
+        last = 0
+        for pos, name in enumerate(filename_list, 1):
+            if name in dir_filenames:
                 continue
-            i = filename_list.index(name) + 1
-            while i in dir_filename_dict.keys():
+            i = max(pos, last + 1)
+            while i in taken:
                 i += 1
+            taken.add(i)
+            last = i
             dir_filename_dict[i] = name
             filename_index[name] = i
         for file in file_list:
@@ -301,10 +597,8 @@ class MagicRename:
                     i = filename_index.get(
                         f"{file['file_name_re']}_{file['updated_at']}", 0
                     )
-                    file["file_name_re"] = re.sub(
-                        match.group(),
-                        str(i).zfill(match.group().count("I")),
-                        file["file_name_re"],
+                    file["file_name_re"] = file["file_name_re"].replace(
+                        match.group(), str(i).zfill(match.group().count("I"))
                     )
 
     def set_dir_file_list(self, file_list, replace):
@@ -326,39 +620,796 @@ class MagicRename:
             pattern = f"({re.escape(pattern).replace('🔣', '.*?').replace('🔢', f')({pattern_i})(')})"
             # print(f"pattern: {pattern}")
             # 获取起始编号
-            if match := re.match(pattern, filename_list[-1]):
+            pattern = re_compile(pattern)
+            if match := pattern.match(filename_list[-1]):
                 self.magic_variable["{I}"] = int(match.group(2))
             # 目录文件列表
             for filename in filename_list:
-                if match := re.match(pattern, filename):
+                if match := pattern.match(filename):
                     self.dir_filename_dict[int(match.group(2))] = (
                         match.group(1) + magic_i + match.group(3)
                     )
             # print(f"filename_list: {self.filename_list}")
 
+    def plan_file_list(
+        self,
+        file_list,
+        pattern,
+        replace,
+        dir_filename_index,
+        update_subdir="",
+        ignore_extension=False,
+        keep_name=False,
+    ):
+        """匹配文件并计算保存的文件名，返回 (需保存的文件, 已存在的文件)
+
+        目录按 update_subdir、文件按 pattern 匹配；目录及 keep_name 时不重命名，
+        其余文件批量替换，文件名写入 file_name_re；原文件名或替换后的文件名
+        已存在的，写入已存在的文件名 file_name_saved。
+        """
+        pattern_re = re_compile(pattern)
+        subdir_re = re_compile(update_subdir) if update_subdir else None
+        need_save_list = []
+        exists_list = []
+        # 待批量重命名的文件
+        rename_list = []
+        for file in file_list:
+            search_re = subdir_re if file["dir"] and subdir_re else pattern_re
+            # 正则文件名匹配
+            if not search_re.search(file["file_name"]):
+                continue
+            # 判断原文件名是否存在，处理忽略扩展名
+            if file_name_saved := self.is_exists(
+                file["file_name"],
+                dir_filename_index,
+                (ignore_extension and not file["dir"]),
+            ):
+                file["file_name_saved"] = file_name_saved
+                exists_list.append(file)
+            elif file["dir"] or keep_name:
+                file["file_name_re"] = file["file_name"]
+                need_save_list.append(file)
+            else:
+                # 待批量重命名，先按顺序占位
+                rename_list.append(file)
+                need_save_list.append(file)
+        # 批量计算替换后的文件名，剔除替换后已存在的
+        if rename_list:
+            file_names_re = self.sub_list(
+                pattern, replace, [f["file_name"] for f in rename_list]
+            )
+            exists_fids = set()
+            for file, file_name_re in zip(rename_list, file_names_re):
+                if file_name_saved := self.is_exists(
+                    file_name_re, dir_filename_index, ignore_extension
+                ):
+                    file["file_name_saved"] = file_name_saved
+                    exists_list.append(file)
+                    exists_fids.add(file["fid"])
+                else:
+                    file["file_name_re"] = file_name_re
+            need_save_list = [f for f in need_save_list if f["fid"] not in exists_fids]
+        return need_save_list, exists_list
+
     def is_exists(self, filename, filename_list, ignore_ext=False):
-        """判断文件是否存在，处理忽略扩展名"""
-        # print(f"filename: {filename} filename_list: {filename_list}")
-        if ignore_ext:
-            filename = os.path.splitext(filename)[0]
-            filename_list = [os.path.splitext(f)[0] for f in filename_list]
-        # {I+} 模式，用I通配数字序号
-        if match := re.search(r"\{I+\}", filename):
-            magic_i = match.group()
-            pattern_i = r"\d" * magic_i.count("I")
-            pattern = re.escape(filename).replace(re.escape(magic_i), pattern_i)
-            for filename in filename_list:
-                if re.match(pattern, filename):
-                    return filename
+        """判断文件是否存在，处理忽略扩展名
+
+        filename_list 可传入 FileNameIndex，同一目录多次查询时避免重复构建
+        """
+        if not isinstance(filename_list, FileNameIndex):
+            filename_list = FileNameIndex(filename_list)
+        return filename_list.find(filename, ignore_ext)
+
+
+class ShareCache:
+    """分享列表持久化缓存（SQLite），按账号 + pwd_id + pdir_fid 记录列表、文件数与最新更新时间"""
+
+    def __init__(self, db_path, ttl=86400, max_entries=5000):
+        self.ttl = int(ttl)
+        self.max_entries = int(max_entries)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # 旧版缓存不区分账号，直接重建
+        columns = [
+            row[1] for row in self.conn.execute("PRAGMA table_info(share_cache)")
+        ]
+        if columns and "account" not in columns:
+            self.conn.execute("DROP TABLE share_cache")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS share_cache (
+                account TEXT,
+                pwd_id TEXT,
+                pdir_fid TEXT,
+                signature TEXT,
+                total INTEGER,
+                max_updated_at INTEGER,
+                first_page TEXT,
+                file_list TEXT,
+                created_at REAL,
+                accessed_at REAL,
+                PRIMARY KEY (account, pwd_id, pdir_fid)
+            );
+            CREATE TABLE IF NOT EXISTS share_cache_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            );
+            """
+        )
+
+    @classmethod
+    def from_config(cls, config_path, cache_config):
+        """按配置创建缓存，数据库位于配置文件目录"""
+        if not cache_config or not cache_config.get("enable"):
             return None
-        else:
-            return filename if filename in filename_list else None
+        db_path = os.path.join(
+            os.path.dirname(os.path.abspath(config_path)), "share_cache.db"
+        )
+        return cls(
+            db_path,
+            cache_config.get("ttl", 86400),
+            cache_config.get("max_entries", 5000),
+        )
+
+    @staticmethod
+    def task_signature(task, subdir_path=""):
+        """任务中影响转存结果的配置，变化时缓存失效"""
+        keys = ("savepath", "pattern", "replace", "ignore_extension", "startfid")
+        sign = json.dumps([task.get(key) for key in keys] + [subdir_path])
+        return hashlib.md5(sign.encode("utf-8")).hexdigest()
+
+    def _first_page(self, share_detail):
+        """首页摘要：文件数、最新更新时间、首页文件指纹"""
+        page_size = share_detail["metadata"].get("_first_page_size", Quark.PAGE_SIZE)
+        file_list = share_detail["data"]["list"][:page_size]
+        first_page = hashlib.md5(
+            "".join(f"{f['fid']}{f.get('updated_at')}" for f in file_list).encode()
+        ).hexdigest()
+        max_updated_at = max((f.get("updated_at", 0) for f in file_list), default=0)
+        return share_detail["metadata"]["_total"], max_updated_at, first_page
+
+    def _incr(self, name):
+        self.conn.execute(
+            "INSERT INTO share_cache_stats (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def is_unchanged(self, account, pwd_id, pdir_fid, signature, share_detail):
+        """首页与缓存一致则判定分享无更新，各账号的转存结果分别记录"""
+        total, max_updated_at, first_page = self._first_page(share_detail)
+        with self.lock, self.conn:
+            # TTL 过期淘汰
+            self.conn.execute(
+                "DELETE FROM share_cache WHERE created_at < ?",
+                (time.time() - self.ttl,),
+            )
+            row = self.conn.execute(
+                "SELECT signature, total, max_updated_at, first_page FROM share_cache "
+                "WHERE account = ? AND pwd_id = ? AND pdir_fid = ?",
+                (account, pwd_id, str(pdir_fid)),
+            ).fetchone()
+            hit = row == (signature, total, max_updated_at, first_page)
+            if hit:
+                self.conn.execute(
+                    "UPDATE share_cache SET accessed_at = ? "
+                    "WHERE account = ? AND pwd_id = ? AND pdir_fid = ?",
+                    (time.time(), account, pwd_id, str(pdir_fid)),
+                )
+            self._incr("hits" if hit else "misses")
+        return hit
+
+    def put(self, account, pwd_id, pdir_fid, signature, share_detail, file_list):
+        total, max_updated_at, first_page = self._first_page(share_detail)
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO share_cache "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    account,
+                    pwd_id,
+                    str(pdir_fid),
+                    signature,
+                    total,
+                    max_updated_at,
+                    first_page,
+                    json.dumps(file_list, ensure_ascii=False),
+                    now,
+                    now,
+                ),
+            )
+            # LRU 淘汰超出数量的条目
+            self.conn.execute(
+                "DELETE FROM share_cache WHERE rowid IN (SELECT rowid FROM share_cache "
+                "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.conn.execute("SELECT name, value FROM share_cache_stats"))
+            entries = self.conn.execute("SELECT COUNT(*) FROM share_cache").fetchone()
+        hits, misses = stats.get("hits", 0), stats.get("misses", 0)
+        return {
+            "entries": entries[0],
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0,
+        }
+
+
+class PathCache:
+    """目录路径 → fid 持久化缓存（SQLite），按账号区分，脚本与 WebUI 共用
+
+    以路径前缀组织，解析时只请求最近已缓存上级目录之后缺失的部分；
+    重命名、删除、移动时按 fid 删除该目录及其下级路径。
+    """
+
+    def __init__(self, db_path, ttl=86400):
+        self.ttl = int(ttl)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS path_cache (
+                account TEXT,
+                path TEXT,
+                fid TEXT,
+                created_at REAL,
+                PRIMARY KEY (account, path)
+            );
+            CREATE INDEX IF NOT EXISTS path_cache_fid ON path_cache (account, fid);
+            """
+        )
+
+    @classmethod
+    def from_config(cls, config_path, cache_config):
+        """按配置创建缓存，数据库位于配置文件目录"""
+        if not cache_config or not cache_config.get("enable"):
+            return None
+        db_path = os.path.join(
+            os.path.dirname(os.path.abspath(config_path)), "path_cache.db"
+        )
+        return cls(db_path, cache_config.get("ttl", 86400))
+
+    def get_many(self, account, paths):
+        """查询路径，返回未过期的 {路径: fid}"""
+        paths = list(paths)
+        result = {}
+        with self.lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i : i + 500]
+                result.update(
+                    self.conn.execute(
+                        f"SELECT path, fid FROM path_cache WHERE account = ? "
+                        f"AND created_at >= ? AND path IN ({','.join('?' * len(chunk))})",
+                        [account, time.time() - self.ttl, *chunk],
+                    )
+                )
+        return result
+
+    def put_many(self, account, path_fids):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO path_cache VALUES (?, ?, ?, ?)",
+                [(account, path, str(fid), now) for path, fid in path_fids.items()],
+            )
+
+    def invalidate_paths(self, account, paths):
+        """删除路径及其下级路径"""
+        with self.lock, self.conn:
+            for path in paths:
+                self.conn.execute(
+                    "DELETE FROM path_cache WHERE account = ? "
+                    "AND (path = ? OR substr(path, 1, ?) = ?)",
+                    (account, path, len(path) + 1, f"{path}/"),
+                )
+
+    def invalidate_fids(self, account, fids):
+        """按 fid 删除目录及其下级路径"""
+        fids = [str(fid) for fid in fids]
+        if not fids:
+            return
+        with self.lock:
+            paths = [
+                row[0]
+                for row in self.conn.execute(
+                    f"SELECT path FROM path_cache WHERE account = ? "
+                    f"AND fid IN ({','.join('?' * len(fids))})",
+                    [account, *fids],
+                )
+            ]
+        self.invalidate_paths(account, paths)
+
+
+class RunJournal:
+    """运行日志（JSONL），每个任务完成后追加一行并落盘，供中断后的下次运行恢复
+
+    记录任务在运行中变化的字段与插件配置，配置文件写回后追加结束标记；
+    未结束且进程已不存在的运行视为中断，其记录回放到配置，窗口期内已完成的任务跳过。
+    """
+
+    TASK_KEYS = ("shareurl_ban", "scan_marks", "addition", "account")
+
+    def __init__(self, path, window=1800):
+        self.path = path
+        self.window = int(window)
+        self.run_id = f"{os.getpid()}-{int(time.time() * 1000)}"
+        self.done = set()
+
+    @classmethod
+    def from_config(cls, config_path, journal_config):
+        """按配置创建，默认启用，日志位于配置文件目录"""
+        journal_config = journal_config or {}
+        if journal_config.get("enable", True) is False:
+            return None
+        journal_path = os.path.join(
+            os.path.dirname(os.path.abspath(config_path)), "run_journal.jsonl"
+        )
+        return cls(journal_path, journal_config.get("window", 1800))
+
+    @staticmethod
+    def task_key(task):
+        key = f"{task.get('taskname')}\t{task.get('shareurl')}\t{task.get('savepath')}"
+        return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _pid_alive(pid):
+        # 同一进程内的运行串行执行，此前未结束的运行已中断
+        if not pid or pid == os.getpid():
+            return False
+        if os.name == "nt":
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    def _read(self):
+        records = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # 中断时未写完的行
+                        pass
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _append(self, records):
+        # 多个运行可能同时进行，读取、清空与追加均在跨进程文件锁内
+        with Config.lock(self.path):
+            self._write(records)
+
+    def _write(self, records):
+        lines = "".join(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in records
+        )
+        with open(self.path, "ab+") as f:
+            # 中断时未写完的行单独成行，不影响之后的记录
+            if f.seek(0, os.SEEK_END):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    lines = "\n" + lines
+            f.write(lines.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def recover(self, config_data):
+        """回放中断运行的记录到配置，返回回放的任务数；并开始记录本次运行"""
+        with Config.lock(self.path):
+            return self._recover(config_data)
+
+    def _recover(self, config_data):
+        records = self._read()
+        runs = {}
+        for record in records:
+            run = runs.setdefault(record["run"], {"pid": None, "ended": False})
+            if record["type"] == "start":
+                run["pid"] = record["pid"]
+            elif record["type"] == "end":
+                run["ended"] = True
+        crashed = {
+            run_id
+            for run_id, run in runs.items()
+            if not run["ended"] and not self._pid_alive(run["pid"])
+        }
+        tasks = {self.task_key(task): task for task in config_data.get("tasklist", [])}
+        recovered = set()
+        now = time.time()
+        for record in records:
+            if record["run"] not in crashed:
+                continue
+            if record["type"] == "task" and record["task"] in tasks:
+                tasks[record["task"]].update(record["state"])
+                recovered.add(record["task"])
+                if record["done"] and now - record["time"] <= self.window:
+                    self.done.add(record["task"])
+            elif record["type"] == "plugin":
+                plugins_config = config_data.setdefault("plugins", {})
+                plugins_config[record["plugin"]] = record["config"]
+        # 无其他运行中的记录时清空日志，否则为中断的运行补上结束标记
+        if all(run["ended"] or run_id in crashed for run_id, run in runs.items()):
+            open(self.path, "w").close()
+        elif crashed:
+            self._write(
+                [{"run": run_id, "type": "end", "time": now} for run_id in crashed]
+            )
+        return len(recovered)
+
+    def start(self):
+        self._append(
+            [
+                {
+                    "run": self.run_id,
+                    "type": "start",
+                    "pid": os.getpid(),
+                    "time": time.time(),
+                }
+            ]
+        )
+
+    def is_done(self, task):
+        return self.task_key(task) in self.done
+
+    def record_task(self, task, done=True):
+        state = {key: task[key] for key in self.TASK_KEYS if key in task}
+        self._append(
+            [
+                {
+                    "run": self.run_id,
+                    "type": "task",
+                    "task": self.task_key(task),
+                    "state": state,
+                    "done": done,
+                    "time": time.time(),
+                }
+            ]
+        )
+
+    def record_plugin(self, plugin_name, plugin_config):
+        self._append(
+            [
+                {
+                    "run": self.run_id,
+                    "type": "plugin",
+                    "plugin": plugin_name,
+                    "config": plugin_config,
+                    "time": time.time(),
+                }
+            ]
+        )
+
+    def end(self):
+        self._append([{"run": self.run_id, "type": "end", "time": time.time()}])
+
+
+class Metrics:
+    """接口请求与任务耗时统计，进程内累计，线程安全
+
+    requests 按接口路径记录次数、耗时分布、响应字节、HTTP 状态、业务 code 与异常；
+    tasks 按任务记录运行次数与各阶段（转存、收尾、插件）耗时。
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.tasks = {}
+
+    @staticmethod
+    def api_path(url):
+        path = urllib.parse.urlparse(url).path
+        return re.sub(r"^/1/clouddrive/", "", path).strip("/")
+
+    def observe_request(self, path, seconds, status, code=None, size=0, error=None):
+        with self.lock:
+            item = self.requests.setdefault(
+                path,
+                {
+                    "count": 0,
+                    "seconds": 0.0,
+                    "bytes": 0,
+                    "buckets": [0] * (len(self.BUCKETS) + 1),
+                    "status": {},
+                    "codes": {},
+                    "errors": {},
+                },
+            )
+            item["count"] += 1
+            item["seconds"] += seconds
+            item["bytes"] += size
+            bucket = next(
+                (i for i, le in enumerate(self.BUCKETS) if seconds <= le),
+                len(self.BUCKETS),
+            )
+            item["buckets"][bucket] += 1
+            item["status"][str(status)] = item["status"].get(str(status), 0) + 1
+            if code is not None:
+                item["codes"][str(code)] = item["codes"].get(str(code), 0) + 1
+            if error:
+                item["errors"][error] = item["errors"].get(error, 0) + 1
+
+    @contextlib.contextmanager
+    def task_timer(self, taskname, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                item = self.tasks.setdefault(
+                    taskname, {"runs": 0, "seconds": 0.0, "stages": {}}
+                )
+                if stage == "save":
+                    item["runs"] += 1
+                item["seconds"] += seconds
+                item["stages"][stage] = item["stages"].get(stage, 0) + seconds
+
+    def snapshot(self):
+        with self.lock:
+            return copy.deepcopy({"requests": self.requests, "tasks": self.tasks})
+
+    @classmethod
+    def _diff(cls, new, old):
+        if isinstance(new, dict):
+            return {
+                key: cls._diff(value, (old or {}).get(key))
+                for key, value in new.items()
+            }
+        if isinstance(new, list):
+            return [
+                cls._diff(value, (old or [0] * len(new))[i])
+                for i, value in enumerate(new)
+            ]
+        return new - (old or 0)
+
+    def summary(self, since=None):
+        """统计摘要，since 为之前的 snapshot 时只统计其后的部分"""
+        data = self._diff(self.snapshot(), since)
+        for path, item in list(data["requests"].items()):
+            if not item["count"]:
+                del data["requests"][path]
+                continue
+            item["seconds"] = round(item["seconds"], 3)
+            item["avg_seconds"] = round(item["seconds"] / item["count"], 3)
+            for key in ("status", "codes", "errors"):
+                item[key] = {k: v for k, v in item[key].items() if v}
+        for taskname, item in list(data["tasks"].items()):
+            if not item["seconds"]:
+                del data["tasks"][taskname]
+                continue
+            item["seconds"] = round(item["seconds"], 3)
+            item["stages"] = {k: round(v, 3) for k, v in item["stages"].items() if v}
+        data["buckets"] = list(self.BUCKETS)
+        return data
+
+    @classmethod
+    def to_prometheus(cls, summary, labels=None):
+        """转换为 Prometheus 文本格式"""
+
+        def fmt(extra):
+            items = {**(labels or {}), **extra}
+            escaped = {
+                k: str(v).replace("\\", "\\\\").replace('"', '\\"')
+                for k, v in items.items()
+            }
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+        lines = []
+        for path, item in summary["requests"].items():
+            lines.append(
+                f"quark_api_requests_total{fmt({'path': path})} {item['count']}"
+            )
+            cumulative = 0
+            for le, count in zip(list(cls.BUCKETS) + ["+Inf"], item["buckets"]):
+                cumulative += count
+                lines.append(
+                    f"quark_api_request_seconds_bucket{fmt({'path': path, 'le': le})} {cumulative}"
+                )
+            lines.append(
+                f"quark_api_request_seconds_sum{fmt({'path': path})} {item['seconds']}"
+            )
+            lines.append(
+                f"quark_api_request_seconds_count{fmt({'path': path})} {item['count']}"
+            )
+            lines.append(
+                f"quark_api_response_bytes_total{fmt({'path': path})} {item['bytes']}"
+            )
+            for status, count in item["status"].items():
+                lines.append(
+                    f"quark_api_responses_total{fmt({'path': path, 'status': status})} {count}"
+                )
+            for code, count in item["codes"].items():
+                lines.append(
+                    f"quark_api_codes_total{fmt({'path': path, 'code': code})} {count}"
+                )
+            for error, count in item["errors"].items():
+                lines.append(
+                    f"quark_api_errors_total{fmt({'path': path, 'error': error})} {count}"
+                )
+        for taskname, item in summary["tasks"].items():
+            lines.append(
+                f"quark_task_runs_total{fmt({'task': taskname})} {item['runs']}"
+            )
+            for stage, seconds in item["stages"].items():
+                lines.append(
+                    f"quark_task_seconds_total{fmt({'task': taskname, 'stage': stage})} {seconds}"
+                )
+        return "".join(f"{line}\n" for line in lines)
+
+
+METRICS = Metrics()
+
+
+class TokenBucket:
+    """令牌桶，每秒补充 rate 个令牌，最多积累 burst 个"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，不足时预支并等待补足"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """熔断器，窗口内错误率过高时暂停请求，冷却后放行一个探测请求
+
+    探测成功则恢复，失败则冷却时间翻倍，直至 max_cooldown。
+    """
+
+    def __init__(
+        self, error_rate=0.5, min_requests=10, window=60, cooldown=30, max_cooldown=600
+    ):
+        self.error_rate = float(error_rate)
+        self.min_requests = int(min_requests)
+        self.window = float(window)
+        self.base_cooldown = float(cooldown)
+        self.max_cooldown = float(max_cooldown)
+        self.cooldown = self.base_cooldown
+        self.results = deque()
+        self.open_until = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """熔断时等待，返回是否为探测请求"""
+        while True:
+            with self.lock:
+                if self.open_until is None:
+                    return False
+                wait = self.open_until - time.monotonic()
+                if wait <= 0:
+                    if not self.probing:
+                        self.probing = True
+                        return True
+                    wait = 0.5
+            time.sleep(wait)
+
+    def record(self, ok, probe=False):
+        with self.lock:
+            now = time.monotonic()
+            if probe:
+                self.probing = False
+                if ok:
+                    self.open_until = None
+                    self.cooldown = self.base_cooldown
+                    self.results.clear()
+                else:
+                    self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                    self.open_until = now + self.cooldown
+                    print(f"⛔ 接口仍异常，暂停请求 {int(self.cooldown)}s")
+                return
+            if self.open_until is not None:
+                return
+            self.results.append((now, ok))
+            while self.results and self.results[0][0] < now - self.window:
+                self.results.popleft()
+            errors = sum(1 for _, result in self.results if not result)
+            error_rate = errors / len(self.results)
+            if len(self.results) < self.min_requests or error_rate < self.error_rate:
+                return
+            self.open_until = now + self.cooldown
+        add_notify(
+            f"⛔ 夸克接口错误率 {error_rate:.0%}，疑似被限流，暂停请求 {int(self.cooldown)}s"
+        )
+
+
+class RequestLimiter:
+    """账号级请求限速与熔断
+
+    接口按类别分别限速：read 浏览列表、save 转存、mutate 新建/重命名/删除/移动。
+    """
+
+    SAVE_PATHS = ("share/sharepage/save", "archive/unarchive")
+    READ_PATHS = (
+        "share/sharepage/token",
+        "share/sharepage/detail",
+        "file/info/path_list",
+        "file/download",
+    )
+
+    def __init__(self, config):
+        self.config = config
+        self.buckets = {
+            kind: TokenBucket(config[kind]["rate"], config[kind].get("burst"))
+            for kind in ("read", "save", "mutate")
+            if config.get(kind, {}).get("rate")
+        }
+        self.breaker = (
+            CircuitBreaker(**config["breaker"]) if config.get("breaker") else None
+        )
+
+    @classmethod
+    def from_config(cls, limit_config, current=None):
+        """按配置创建，未启用时返回 None；配置未变时沿用 current 的状态"""
+        if not limit_config or not limit_config.get("enable"):
+            return None
+        if current is not None and current.config == limit_config:
+            return current
+        return cls(copy.deepcopy(limit_config))
+
+    def kind(self, method, api_path):
+        if api_path in self.SAVE_PATHS:
+            return "save"
+        if method == "GET" or api_path in self.READ_PATHS:
+            return "read"
+        return "mutate"
+
+    def before(self, method, api_path):
+        """请求前等待熔断恢复与令牌，返回是否为熔断探测请求"""
+        probe = self.breaker.wait() if self.breaker else False
+        if bucket := self.buckets.get(self.kind(method, api_path)):
+            bucket.acquire()
+        return probe
+
+    def after(self, status, probe=False):
+        if self.breaker:
+            self.breaker.record(status < 500 and status != 429, probe)
 
 
 class Quark:
     BASE_URL = "https://drive-pc.quark.cn"
     BASE_URL_APP = "https://drive-m.quark.cn"
     USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) quark-cloud-drive/3.14.2 Chrome/112.0.5615.165 Electron/24.1.3.8 Safari/537.36 Channel/pckk_other_ch"
+    # 连接池：每个主机的最大连接数、请求超时(秒)、传输层重试次数
+    POOL_MAXSIZE = int(os.environ.get("POOL_MAXSIZE", 10))
+    REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", 30))
+    REQUEST_RETRIES = int(os.environ.get("REQUEST_RETRIES", 3))
+    # 列表分页：每页条数、并发获取的最大页数
+    PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 50))
+    PAGE_WORKERS = int(os.environ.get("PAGE_WORKERS", 4))
+    # 任务轮询：初始间隔、最大间隔、单个任务超时(秒)
+    TASK_POLL_INTERVAL = 0.5
+    TASK_POLL_MAX_INTERVAL = 5
+    TASK_POLL_TIMEOUT = int(os.environ.get("TASK_POLL_TIMEOUT", 600))
+    # 重命名并发
+    RENAME_WORKERS = int(os.environ.get("RENAME_WORKERS", 4))
+    RENAME_RETRIES = int(os.environ.get("RENAME_RETRIES", 2))
+    MKDIR_WORKERS = int(os.environ.get("MKDIR_WORKERS", 4))
 
     def __init__(self, cookie="", index=0):
         self.cookie = cookie.strip()
@@ -367,6 +1418,38 @@ class Quark:
         self.nickname = ""
         self.mparam = self._match_mparam_form_cookie(cookie)
         self.savepath_fid = {"/": "0"}
+        self.session = self._create_session()
+        self.share_cache = None
+        self.path_cache = None
+        # 请求限速与熔断，None 为不限制
+        self.limiter = None
+        # 单次运行内的目录列表缓存，None 为不启用；异步任务的目标目录待完成后失效
+        self.ls_dir_cache = None
+        self.task_pdir_fids = {}
+        # 延迟重命名：保存路径 → 待重命名的目录树，None 为即时重命名
+        self.pending_renames = None
+        self.rename_count = 0
+        self._rename_lock = threading.Lock()
+
+    def _create_session(self):
+        """创建复用连接的会话，按主机维持连接池"""
+        session = requests.Session()
+        # 仅重试连接失败及幂等请求，避免转存等POST请求重复提交
+        retry = Retry(
+            total=self.REQUEST_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=4, pool_maxsize=self.POOL_MAXSIZE, max_retries=retry
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        # cookie 由请求头显式传入，会话不保存响应 cookie
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
 
     def _match_mparam_form_cookie(self, cookie):
         mparam = {}
@@ -419,12 +1502,31 @@ class Quark:
                 }
             )
             del headers["cookie"]
+        kwargs.setdefault("timeout", self.REQUEST_TIMEOUT)
+        api_path = Metrics.api_path(url)
+        probe = self.limiter.before(method, api_path) if self.limiter else False
+        start = time.perf_counter()
         try:
-            response = requests.request(method, url, headers=headers, **kwargs)
+            response = self.session.request(method, url, headers=headers, **kwargs)
             # print(f"{response.text}")
             # response.raise_for_status()  # 检查请求是否成功，但返回非200也会抛出异常
+            if self.limiter:
+                self.limiter.after(response.status_code, probe)
+            code = re.search(rb'"code"\s*:\s*(-?\d+)', response.content[:256])
+            METRICS.observe_request(
+                api_path,
+                time.perf_counter() - start,
+                response.status_code,
+                int(code.group(1)) if code else None,
+                len(response.content),
+            )
             return response
         except Exception as e:
+            if self.limiter:
+                self.limiter.after(500, probe)
+            METRICS.observe_request(
+                api_path, time.perf_counter() - start, 500, error=type(e).__name__
+            )
             print(f"_send_request error:\n{e}")
             fake_response = requests.Response()
             fake_response.status_code = 500
@@ -433,6 +1535,87 @@ class Quark:
             )
             return fake_response
 
+    def _get_all_pages(self, url, querystring, max_pages=0, stop_at=None):
+        """获取全部分页：首页取得总数后，并发请求其余页并按页序合并
+
+        stop_at 为上次记录的最新文件 {"fid", "updated_at"}，列表按更新时间倒序，
+        逐页获取至出现该文件或更早的文件即停止。
+        服务端可能限制每页条数，页数按首页实际条数计算，仍不足总数时逐页补齐。
+        """
+        querystring = {**querystring, "_page": 1, "_size": self.PAGE_SIZE}
+        response = self._send_request("GET", url, params=querystring).json()
+        if response["code"] != 0:
+            return response
+        list_merge = response["data"]["list"]
+        total = response["metadata"]["_total"]
+        response["metadata"]["_first_page_size"] = len(list_merge)
+        if not list_merge or len(list_merge) >= total:
+            return response
+        page_count = math.ceil(total / len(list_merge))
+        if max_pages:
+            page_count = min(page_count, max_pages)
+
+        def get_page(page):
+            params = {**querystring, "_page": page}
+            return self._send_request("GET", url, params=params).json()
+
+        def reach_mark(file_list):
+            return any(
+                not f["dir"]
+                and (
+                    f["fid"] == stop_at["fid"]
+                    or f["updated_at"] < stop_at["updated_at"]
+                )
+                for f in file_list
+            )
+
+        page = 2
+        if not stop_at and page_count > 1:
+            pages = range(2, page_count + 1)
+            with ThreadPoolExecutor(
+                max_workers=min(self.PAGE_WORKERS, len(pages))
+            ) as executor:
+                for page_response in executor.map(get_page, pages):
+                    if page_response["code"] != 0:
+                        return page_response
+                    list_merge += page_response["data"]["list"]
+            page = page_count + 1
+        # 逐页获取：增量扫描至上次记录的文件为止，或并发获取后仍不足总数
+        file_list = response["data"]["list"]
+        while len(list_merge) < total and (not max_pages or page <= max_pages):
+            if stop_at and reach_mark(file_list):
+                break
+            page_response = get_page(page)
+            if page_response["code"] != 0:
+                return page_response
+            file_list = page_response["data"]["list"]
+            if not file_list:
+                break
+            list_merge += file_list
+            page += 1
+        response["data"]["list"] = list_merge
+        return response
+
+    def _invalidate_ls_dir(self, pdir_fids=(), fids=()):
+        """移除受影响的目录列表缓存：目录本身，及包含指定文件的目录"""
+        if self.ls_dir_cache is None:
+            return
+        if pdir_fids is None:
+            self.ls_dir_cache.clear()
+            return
+        fids = {str(fid) for fid in fids}
+        pdir_fids = {str(fid) for fid in pdir_fids} | fids
+        for key, response in list(self.ls_dir_cache.items()):
+            if key[0] in pdir_fids or any(
+                f["fid"] in fids for f in response["data"]["list"]
+            ):
+                self.ls_dir_cache.pop(key, None)
+
+    def _copy_listing(self, response):
+        """复制列表响应，调用方修改列表不影响缓存"""
+        data = {**response["data"], "list": list(response["data"]["list"])}
+        return {**response, "data": data}
+
     def init(self):
         account_info = self.get_account_info()
         if account_info:
@@ -505,40 +1688,31 @@ class Quark:
         return response
 
     def get_detail(
-        self, pwd_id, stoken, pdir_fid, _fetch_share=0, fetch_share_full_path=0
+        self,
+        pwd_id,
+        stoken,
+        pdir_fid,
+        _fetch_share=0,
+        fetch_share_full_path=0,
+        max_pages=0,
+        stop_at=None,
     ):
-        list_merge = []
-        page = 1
-        while True:
-            url = f"{self.BASE_URL}/1/clouddrive/share/sharepage/detail"
-            querystring = {
-                "pr": "ucpro",
-                "fr": "pc",
-                "pwd_id": pwd_id,
-                "stoken": stoken,
-                "pdir_fid": pdir_fid,
-                "force": "0",
-                "_page": page,
-                "_size": "50",
-                "_fetch_banner": "0",
-                "_fetch_share": _fetch_share,
-                "_fetch_total": "1",
-                "_sort": "file_type:asc,updated_at:desc",
-                "ver": "2",
-                "fetch_share_full_path": fetch_share_full_path,
-            }
-            response = self._send_request("GET", url, params=querystring).json()
-            if response["code"] != 0:
-                return response
-            if response["data"]["list"]:
-                list_merge += response["data"]["list"]
-                page += 1
-            else:
-                break
-            if len(list_merge) >= response["metadata"]["_total"]:
-                break
-        response["data"]["list"] = list_merge
-        return response
+        url = f"{self.BASE_URL}/1/clouddrive/share/sharepage/detail"
+        querystring = {
+            "pr": "ucpro",
+            "fr": "pc",
+            "pwd_id": pwd_id,
+            "stoken": stoken,
+            "pdir_fid": pdir_fid,
+            "force": "0",
+            "_fetch_banner": "0",
+            "_fetch_share": _fetch_share,
+            "_fetch_total": "1",
+            "_sort": "file_type:asc,updated_at:desc",
+            "ver": "2",
+            "fetch_share_full_path": fetch_share_full_path,
+        }
+        return self._get_all_pages(url, querystring, max_pages, stop_at)
 
     def get_fids(self, file_paths):
         fids = []
@@ -559,36 +1733,83 @@ class Quark:
                 break
         return fids
 
-    def ls_dir(self, pdir_fid, **kwargs):
-        list_merge = []
-        page = 1
-        while True:
-            url = f"{self.BASE_URL}/1/clouddrive/file/sort"
-            querystring = {
-                "pr": "ucpro",
-                "fr": "pc",
-                "uc_param_str": "",
-                "pdir_fid": pdir_fid,
-                "_page": page,
-                "_size": "50",
-                "_fetch_total": "1",
-                "_fetch_sub_dirs": "0",
-                "_sort": "file_type:asc,updated_at:desc",
-                "_fetch_full_path": kwargs.get("fetch_full_path", 0),
-                "fetch_all_file": 1,  # 跟随Web端，作用未知
-                "fetch_risk_file_name": 1,  # 如无此参数，违规文件名会被变 ***
+    @property
+    def path_cache_account(self):
+        return hashlib.md5(self.cookie.encode("utf-8")).hexdigest()
+
+    def resolve_fids(self, file_paths):
+        """解析目录路径的 fid，返回 {路径: fid}
+
+        启用路径缓存时，每个路径从最近的已缓存上级目录起补全缺失的各级路径，
+        所有未知路径合并为一次 get_fids 请求，结果写回缓存。
+        """
+        file_paths = list(dict.fromkeys(file_paths))
+        result = {"/": "0"} if "/" in file_paths else {}
+        file_paths = [path for path in file_paths if path != "/"]
+        if not self.path_cache:
+            if file_paths:
+                result.update(
+                    {
+                        item["file_path"]: item["fid"]
+                        for item in self.get_fids(file_paths)
+                    }
+                )
+            return result
+        account = self.path_cache_account
+        prefixes = {
+            path: ["/".join(path.split("/")[:i]) for i in range(2, path.count("/") + 2)]
+            for path in file_paths
+        }
+        cached = self.path_cache.get_many(
+            account, {prefix for p in prefixes.values() for prefix in p}
+        )
+        missing = []
+        for path, path_prefixes in prefixes.items():
+            if path in cached:
+                continue
+            known = max(
+                (i for i, prefix in enumerate(path_prefixes) if prefix in cached),
+                default=-1,
+            )
+            missing.extend(path_prefixes[known + 1 :])
+        if missing:
+            fetched = {
+                item["file_path"]: item["fid"]
+                for item in self.get_fids(list(dict.fromkeys(missing)))
             }
-            response = self._send_request("GET", url, params=querystring).json()
-            if response["code"] != 0:
-                return response
-            if response["data"]["list"]:
-                list_merge += response["data"]["list"]
-                page += 1
-            else:
-                break
-            if len(list_merge) >= response["metadata"]["_total"]:
-                break
-        response["data"]["list"] = list_merge
+            self.path_cache.put_many(account, fetched)
+            cached.update(fetched)
+        result.update(cached)
+        return result
+
+    def _invalidate_path_cache(self, paths=(), fids=()):
+        if self.path_cache:
+            if paths:
+                self.path_cache.invalidate_paths(self.path_cache_account, paths)
+            if fids:
+                self.path_cache.invalidate_fids(self.path_cache_account, fids)
+
+    def ls_dir(self, pdir_fid, **kwargs):
+        cache_key = (str(pdir_fid), kwargs.get("fetch_full_path", 0))
+        if self.ls_dir_cache is not None and cache_key in self.ls_dir_cache:
+            return self._copy_listing(self.ls_dir_cache[cache_key])
+        url = f"{self.BASE_URL}/1/clouddrive/file/sort"
+        querystring = {
+            "pr": "ucpro",
+            "fr": "pc",
+            "uc_param_str": "",
+            "pdir_fid": pdir_fid,
+            "_fetch_total": "1",
+            "_fetch_sub_dirs": "0",
+            "_sort": "file_type:asc,updated_at:desc",
+            "_fetch_full_path": kwargs.get("fetch_full_path", 0),
+            "fetch_all_file": 1,  # 跟随Web端，作用未知
+            "fetch_risk_file_name": 1,  # 如无此参数，违规文件名会被变 ***
+        }
+        response = self._get_all_pages(url, querystring)
+        if self.ls_dir_cache is not None and response["code"] == 0:
+            self.ls_dir_cache[cache_key] = response
+            response = self._copy_listing(response)
         return response
 
     def save_file(self, fid_list, fid_token_list, to_pdir_fid, pwd_id, stoken):
@@ -613,40 +1834,96 @@ class Quark:
         response = self._send_request(
             "POST", url, json=payload, params=querystring
         ).json()
+        self._invalidate_ls_dir([to_pdir_fid])
+        if response.get("code") == 0:
+            self.task_pdir_fids[response["data"]["task_id"]] = to_pdir_fid
         return response
 
-    def query_task(self, task_id):
+    def _query_task_once(self, task_id, retry_index=0):
+        url = f"{self.BASE_URL}/1/clouddrive/task"
+        querystring = {
+            "pr": "ucpro",
+            "fr": "pc",
+            "uc_param_str": "",
+            "task_id": task_id,
+            "retry_index": retry_index,
+            "__dt": int(random.uniform(1, 5) * 60 * 1000),
+            "__t": datetime.now().timestamp(),
+        }
+        return self._send_request("GET", url, params=querystring).json()
+
+    def query_tasks(self, task_ids, timeout=None, first_completed=False):
+        """批量轮询任务状态
+
+        每轮查询全部未完成的任务，轮询间隔指数退避并加随机抖动；
+        超过 timeout 秒仍未完成的任务返回 {"timeout": True, ...}，不再无限等待。
+
+        :param first_completed: 任一任务结束即返回，未结束的任务不在结果中
+        :return: {task_id: response}
+        """
+        timeout = self.TASK_POLL_TIMEOUT if timeout is None else timeout
+        deadline = time.time() + timeout
+        pending = list(dict.fromkeys(task_ids))
+        results = {}
         retry_index = 0
-        while True:
-            url = f"{self.BASE_URL}/1/clouddrive/task"
-            querystring = {
-                "pr": "ucpro",
-                "fr": "pc",
-                "uc_param_str": "",
-                "task_id": task_id,
-                "retry_index": retry_index,
-                "__dt": int(random.uniform(1, 5) * 60 * 1000),
-                "__t": datetime.now().timestamp(),
-            }
-            response = self._send_request("GET", url, params=querystring).json()
-            if response["status"] != 200:
-                return response
-            if response["data"]["status"] == 2:
-                if retry_index > 0:
-                    print()
+        interval = self.TASK_POLL_INTERVAL
+        while pending:
+            if len(pending) > 1:
+                with ThreadPoolExecutor(
+                    max_workers=min(len(pending), self.PAGE_WORKERS)
+                ) as executor:
+                    responses = list(
+                        executor.map(
+                            lambda task_id: self._query_task_once(task_id, retry_index),
+                            pending,
+                        )
+                    )
+            else:
+                responses = [self._query_task_once(pending[0], retry_index)]
+            responses = dict(zip(pending, responses))
+            for task_id, response in responses.items():
+                if response["status"] != 200 or response["data"]["status"] == 2:
+                    results[task_id] = response
+                    pending.remove(task_id)
+                    if task_id in self.task_pdir_fids:
+                        self._invalidate_ls_dir([self.task_pdir_fids.pop(task_id)])
+            if not pending or (first_completed and results):
+                break
+            if time.time() >= deadline:
+                print(f"（超时 {timeout}s）", end="")
+                for task_id in pending:
+                    results[task_id] = {
+                        "status": 504,
+                        "code": 504,
+                        "message": f"任务执行超时(>{timeout}s)",
+                        "timeout": True,
+                        "data": {"task_id": task_id},
+                    }
                 break
+            if retry_index == 0:
+                # 标题取自仍未完成的任务，已结束的任务可能是无 data 的错误响应
+                waiting = (
+                    responses[pending[0]].get("data", {}).get("task_title", "")
+                    if len(pending) == 1
+                    else f"{len(pending)}个任务"
+                )
+                print(f"正在等待[{waiting}]执行结果", end="", flush=True)
             else:
-                if retry_index == 0:
-                    print(
-                        f"正在等待[{response['data']['task_title']}]执行结果",
-                        end="",
-                        flush=True,
-                    )
-                else:
-                    print(".", end="", flush=True)
-                retry_index += 1
-                time.sleep(0.500)
-        return response
+                print(".", end="", flush=True)
+            retry_index += 1
+            time.sleep(
+                min(
+                    random.uniform(interval / 2, interval),
+                    max(deadline - time.time(), 0),
+                )
+            )
+            interval = min(interval * 1.5, self.TASK_POLL_MAX_INTERVAL)
+        if retry_index > 0:
+            print()
+        return results
+
+    def query_task(self, task_id, timeout=None):
+        return self.query_tasks([task_id], timeout)[task_id]
 
     def download(self, fids):
         url = f"{self.BASE_URL}/1/clouddrive/file/download"
@@ -669,6 +1946,13 @@ class Quark:
         response = self._send_request(
             "POST", url, json=payload, params=querystring
         ).json()
+        # 父目录未知时（可能同时创建多级目录）清空缓存
+        parent_fid = self.savepath_fid.get(os.path.dirname(dir_path.rstrip("/")))
+        self._invalidate_ls_dir([parent_fid] if parent_fid else None)
+        if self.path_cache and response.get("code") == 0:
+            self.path_cache.put_many(
+                self.path_cache_account, {dir_path: response["data"]["fid"]}
+            )
         return response
 
     def rename(self, fid, file_name):
@@ -678,6 +1962,8 @@ class Quark:
         response = self._send_request(
             "POST", url, json=payload, params=querystring
         ).json()
+        self._invalidate_ls_dir(fids=[fid])
+        self._invalidate_path_cache(fids=[fid])
         return response
 
     def delete(self, filelist):
@@ -687,6 +1973,8 @@ class Quark:
         response = self._send_request(
             "POST", url, json=payload, params=querystring
         ).json()
+        self._invalidate_ls_dir(fids=filelist)
+        self._invalidate_path_cache(fids=filelist)
         return response
 
     def recycle_list(self, page=1, size=30):
@@ -727,6 +2015,9 @@ class Quark:
         response = self._send_request(
             "POST", url, json=payload, params=querystring
         ).json()
+        self._invalidate_ls_dir([to_pdir_fid])
+        if response.get("code") == 0:
+            self.task_pdir_fids[response["data"]["task_id"]] = to_pdir_fid
         return response
 
     def move_files(self, fids, to_pdir_fid):
@@ -741,6 +2032,8 @@ class Quark:
         response = self._send_request(
             "POST", url, json=payload, params=querystring
         ).json()
+        self._invalidate_ls_dir([to_pdir_fid], fids)
+        self._invalidate_path_cache(fids=fids)
         return response
 
     # ↑ 请求函数
@@ -764,6 +2057,57 @@ class Quark:
         pdir_fid = paths[-1]["fid"] if matches else 0
         return pwd_id, passcode, pdir_fid, paths
 
+    def mkdirs(self, dir_paths):
+        """并发创建多个目录，返回 {路径: fid}
+
+        多个目录共用的缺失上级目录先按层级创建，避免并发请求重复创建同一上级目录。
+        """
+        dir_paths = set(dir_paths)
+        prefix_count = {}
+        for dir_path in dir_paths:
+            parts = dir_path.rstrip("/").split("/")
+            for i in range(2, len(parts)):
+                prefix = "/".join(parts[:i])
+                prefix_count[prefix] = prefix_count.get(prefix, 0) + 1
+        # 共用的上级目录，若其下目录都经由同一更深的共用目录，由后者一并创建
+        shared = [
+            prefix
+            for prefix, count in prefix_count.items()
+            if count > 1 and prefix not in dir_paths
+        ]
+        shared = [
+            prefix
+            for prefix in shared
+            if not any(
+                other.startswith(f"{prefix}/") and prefix_count[other] == count
+                for other in shared
+                for count in [prefix_count[prefix]]
+            )
+        ]
+        if shared:
+            existing = self.resolve_fids(shared)
+            dir_paths |= {prefix for prefix in shared if prefix not in existing}
+        levels = {}
+        for dir_path in dir_paths:
+            levels.setdefault(dir_path.rstrip("/").count("/"), []).append(dir_path)
+        created = {}
+        if not dir_paths:
+            return created
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.MKDIR_WORKERS, len(dir_paths)))
+        ) as executor:
+            for level in sorted(levels):
+                level_paths = sorted(levels[level])
+                for dir_path, mkdir_return in zip(
+                    level_paths, executor.map(self.mkdir, level_paths)
+                ):
+                    if mkdir_return["code"] == 0:
+                        created[dir_path] = mkdir_return["data"]["fid"]
+                        print(f"创建文件夹：{dir_path}")
+                    else:
+                        print(f"创建文件夹：{dir_path} 失败, {mkdir_return['message']}")
+        return created
+
     def update_savepath_fid(self, tasklist):
         dir_paths = [
             re.sub(r"/{2,}", "/", f"/{item['savepath']}")
@@ -776,20 +2120,16 @@ class Quark:
         ]
         if not dir_paths:
             return False
-        dir_paths_exist_arr = self.get_fids(dir_paths)
+        dir_paths_exist_arr = [
+            {"file_path": path, "fid": fid}
+            for path, fid in self.resolve_fids(dir_paths).items()
+            if path in dir_paths
+        ]
         dir_paths_exist = [item["file_path"] for item in dir_paths_exist_arr]
         # 比较创建不存在的
         dir_paths_unexist = list(set(dir_paths) - set(dir_paths_exist) - set(["/"]))
-        for dir_path in dir_paths_unexist:
-            mkdir_return = self.mkdir(dir_path)
-            if mkdir_return["code"] == 0:
-                new_dir = mkdir_return["data"]
-                dir_paths_exist_arr.append(
-                    {"file_path": dir_path, "fid": new_dir["fid"]}
-                )
-                print(f"创建文件夹：{dir_path}")
-            else:
-                print(f"创建文件夹：{dir_path} 失败, {mkdir_return['message']}")
+        for dir_path, fid in self.mkdirs(dir_paths_unexist).items():
+            dir_paths_exist_arr.append({"file_path": dir_path, "fid": fid})
         # 储存目标目录的fid
         for dir_path in dir_paths_exist_arr:
             self.savepath_fid[dir_path["file_path"]] = dir_path["fid"]
@@ -836,7 +2176,7 @@ class Quark:
             print(f"❌ 转存测试失败: {str(e)}")
             traceback.print_exc()
 
-    def do_save_task(self, task):
+    def do_save_task(self, task, saves=None):
         # 判断资源失效记录
         if task.get("shareurl_ban"):
             print(f"《{task['taskname']}》：{task['shareurl_ban']}")
@@ -859,20 +2199,63 @@ class Quark:
             return
         # print("stoken: ", stoken)
 
-        updated_tree = self.dir_check_and_save(task, pwd_id, stoken, pdir_fid)
+        updated_tree = self.dir_check_and_save(
+            task, pwd_id, stoken, pdir_fid, saves=saves
+        )
+        if saves is not None:
+            # 流水线模式：转存结果由 finish_saves 统一等待后再调用 finish_save_task
+            return updated_tree
+        return self.finish_save_task(task, updated_tree)
+
+    def finish_save_task(self, task, updated_tree):
         if updated_tree.size(1) > 0:
-            self.do_rename(updated_tree)
-            print()
+            if self.pending_renames is None:
+                self.do_rename(updated_tree)
+                print()
+            else:
+                savepath = re.sub(r"/{2,}", "/", f"/{task['savepath']}")
+                with self._rename_lock:
+                    self.pending_renames.setdefault(savepath, []).append(updated_tree)
             add_notify(f"✅《{task['taskname']}》添加追更：\n{updated_tree}")
             return updated_tree
         else:
             print(f"任务结束：没有新的转存任务")
             return False
 
-    def dir_check_and_save(self, task, pwd_id, stoken, pdir_fid="", subdir_path=""):
+    def dir_check_and_save(
+        self, task, pwd_id, stoken, pdir_fid="", subdir_path="", saves=None
+    ):
+        """检查并提交转存，saves 不为 None 时仅提交，由调用方 finish_saves 统一等待"""
         tree = Tree()
-        # 获取分享文件列表
-        share_file_list = self.get_detail(pwd_id, stoken, pdir_fid)["data"]["list"]
+        own_saves = saves is None
+        if own_saves:
+            saves = []
+        # 分享列表缓存，更新子目录的任务不使用（子目录变化不体现在首页）
+        share_cache = None if task.get("update_subdir") else self.share_cache
+        # 增量扫描：记录每个分享目录已见过的最新文件，翻页至此为止
+        scan_marks = (
+            task.setdefault("scan_marks", {})
+            if CONFIG_DATA.get("incremental_scan")
+            else {}
+        )
+        scan_sign = ShareCache.task_signature(task, subdir_path)
+
+        def scan_mark(share_fid):
+            # 任务配置变化后旧的记录不再适用，重新完整扫描
+            mark = scan_marks.get(f"{pwd_id}/{share_fid}")
+            return mark if mark and mark.get("sign") == scan_sign else None
+
+        # 获取分享文件列表，启用缓存时先取首页判断有无变化
+        max_pages = 1 if share_cache else 0
+        share_fid = pdir_fid
+        share_detail = self.get_detail(
+            pwd_id,
+            stoken,
+            share_fid,
+            max_pages=max_pages,
+            stop_at=scan_mark(share_fid),
+        )
+        share_file_list = share_detail["data"]["list"]
         # print("share_file_list: ", share_file_list)
 
         if not share_file_list:
@@ -886,21 +2269,59 @@ class Quark:
             and subdir_path == ""
         ):  # 仅有一个文件夹
             print("🧠 该分享是一个文件夹，读取文件夹内列表")
-            share_file_list = self.get_detail(
-                pwd_id, stoken, share_file_list[0]["fid"]
-            )["data"]["list"]
+            share_fid = share_file_list[0]["fid"]
+            share_detail = self.get_detail(
+                pwd_id,
+                stoken,
+                share_fid,
+                max_pages=max_pages,
+                stop_at=scan_mark(share_fid),
+            )
+            share_file_list = share_detail["data"]["list"]
+
+        if share_cache:
+            cache_sign = share_cache.task_signature(task, subdir_path)
+            if share_cache.is_unchanged(
+                self.path_cache_account, pwd_id, share_fid, cache_sign, share_detail
+            ):
+                print("🗃️ 分享列表无变化，跳过检查")
+                return tree
+            if len(share_file_list) < share_detail["metadata"]["_total"]:
+                share_file_list = self.get_detail(
+                    pwd_id,
+                    stoken,
+                    share_fid,
+                    stop_at=scan_mark(share_fid),
+                )["data"]["list"]
 
         # 获取目标目录文件列表
         savepath = re.sub(r"/{2,}", "/", f"/{task['savepath']}{subdir_path}")
         if not self.savepath_fid.get(savepath):
-            if get_fids := self.get_fids([savepath]):
-                self.savepath_fid[savepath] = get_fids[0]["fid"]
+            if fid := self.resolve_fids([savepath]).get(savepath):
+                self.savepath_fid[savepath] = fid
             else:
                 print(f"❌ 目录 {savepath} fid获取失败，跳过转存")
                 return tree
         to_pdir_fid = self.savepath_fid[savepath]
-        dir_file_list = self.ls_dir(to_pdir_fid)["data"]["list"]
+        dir_ls = self.ls_dir(to_pdir_fid)
+        if dir_ls.get("code") != 0 and self.path_cache:
+            # 缓存的目录可能已在别处删除或移动，重新解析
+            self._invalidate_path_cache(paths=[savepath])
+            fid = self.resolve_fids([savepath]).get(savepath)
+            # 已被删除则重新创建，同运行开始时的 update_savepath_fid
+            if not fid:
+                fid = self.mkdirs([savepath]).get(savepath)
+            if fid:
+                self.savepath_fid[savepath] = to_pdir_fid = fid
+                dir_ls = self.ls_dir(to_pdir_fid)
+        if dir_ls.get("code") != 0:
+            print(
+                f"❌ 目录 {savepath} 获取文件列表失败，跳过转存: {dir_ls.get('message')}"
+            )
+            return tree
+        dir_file_list = dir_ls["data"]["list"]
         dir_filename_list = [dir_file["file_name"] for dir_file in dir_file_list]
+        dir_filename_index = FileNameIndex(dir_filename_list)
         # print("dir_file_list: ", dir_file_list)
 
         tree.create_node(
@@ -919,91 +2340,71 @@ class Quark:
         pattern, replace = mr.magic_regex_conv(
             task.get("pattern", ""), task.get("replace", "")
         )
-        # 需保存的文件清单
-        need_save_list = []
-        # 添加符合的
-        for share_file in share_file_list:
-            search_pattern = (
-                task["update_subdir"]
-                if share_file["dir"] and task.get("update_subdir")
-                else pattern
-            )
-            # 正则文件名匹配
-            if re.search(search_pattern, share_file["file_name"]):
-                # 判断原文件名是否存在，处理忽略扩展名
-                if not mr.is_exists(
-                    share_file["file_name"],
-                    dir_filename_list,
-                    (task.get("ignore_extension") and not share_file["dir"]),
-                ):
-                    # 文件夹、子目录文件不进行重命名
-                    if share_file["dir"] or subdir_path:
-                        share_file["file_name_re"] = share_file["file_name"]
-                        need_save_list.append(share_file)
-                    else:
-                        # 替换后的文件名
-                        file_name_re = mr.sub(pattern, replace, share_file["file_name"])
-                        # 判断替换后的文件名是否存在
-                        if not mr.is_exists(
-                            file_name_re,
-                            dir_filename_list,
-                            task.get("ignore_extension"),
-                        ):
-                            share_file["file_name_re"] = file_name_re
-                            need_save_list.append(share_file)
-                elif share_file["dir"]:
-                    # 存在并是一个目录，历遍子目录
-                    if task.get("update_subdir", False) and re.search(
-                        task["update_subdir"], share_file["file_name"]
-                    ):
-                        if task.get("update_subdir_resave_mode", False):
-                            # 重存模式：删除该目录下所有文件，重新转存
-                            print(f"重存子目录：{savepath}/{share_file['file_name']}")
-                            # 删除子目录、回收站中彻底删除
-                            subdir = next(
-                                (
-                                    f
-                                    for f in dir_file_list
-                                    if f["file_name"] == share_file["file_name"]
-                                ),
-                                None,
-                            )
-                            delete_return = self.delete([subdir["fid"]])
-                            self.query_task(delete_return["data"]["task_id"])
-                            recycle_list = self.recycle_list()
-                            record_id_list = [
-                                item["record_id"]
-                                for item in recycle_list
-                                if item["fid"] == subdir["fid"]
-                            ]
-                            self.recycle_remove(record_id_list)
-                            # 作为新文件添加到转存列表
-                            share_file["file_name_re"] = share_file["file_name"]
-                            need_save_list.append(share_file)
-                        else:
-                            # 递归模式
-                            print(f"检查子目录：{savepath}/{share_file['file_name']}")
-                            subdir_tree = self.dir_check_and_save(
-                                task,
-                                pwd_id,
-                                stoken,
-                                share_file["fid"],
-                                f"{subdir_path}/{share_file['file_name']}",
-                            )
-                            if subdir_tree.size(1) > 0:
-                                # 合并子目录树
-                                tree.create_node(
-                                    "📁" + share_file["file_name"],
-                                    share_file["fid"],
-                                    parent=pdir_fid,
-                                    data={
-                                        "is_dir": share_file["dir"],
-                                    },
-                                )
-                                tree.merge(share_file["fid"], subdir_tree, deep=False)
-            # 指定文件开始订阅/到达指定文件（含）结束历遍
-            if share_file["fid"] == task.get("startfid", ""):
-                break
+        # 指定文件开始订阅/到达指定文件（含）结束历遍
+        share_fids = [f["fid"] for f in share_file_list]
+        if task.get("startfid") in share_fids:
+            share_file_list = share_file_list[: share_fids.index(task["startfid"]) + 1]
+        # 需保存的文件清单，文件夹、子目录文件不进行重命名
+        need_save_list, exists_list = mr.plan_file_list(
+            share_file_list,
+            pattern,
+            replace,
+            dir_filename_index,
+            task.get("update_subdir", ""),
+            task.get("ignore_extension"),
+            keep_name=bool(subdir_path),
+        )
+        subdir_re = (
+            re_compile(task["update_subdir"]) if task.get("update_subdir") else None
+        )
+        # 待合并的子目录树
+        subdir_trees = []
+        for share_file in exists_list:
+            # 存在并是一个目录，历遍子目录
+            if (
+                share_file["dir"]
+                and subdir_re
+                and subdir_re.search(share_file["file_name"])
+            ):
+                if task.get("update_subdir_resave_mode", False):
+                    # 重存模式：删除该目录下所有文件，重新转存
+                    print(f"重存子目录：{savepath}/{share_file['file_name']}")
+                    # 删除子目录、回收站中彻底删除
+                    subdir = next(
+                        (
+                            f
+                            for f in dir_file_list
+                            if f["file_name"] == share_file["file_name"]
+                        ),
+                        None,
+                    )
+                    delete_return = self.delete([subdir["fid"]])
+                    self.query_task(delete_return["data"]["task_id"])
+                    recycle_list = self.recycle_list()
+                    record_id_list = [
+                        item["record_id"]
+                        for item in recycle_list
+                        if item["fid"] == subdir["fid"]
+                    ]
+                    self.recycle_remove(record_id_list)
+                    # 作为新文件添加到转存列表
+                    share_file["file_name_re"] = share_file["file_name"]
+                    need_save_list.append(share_file)
+                else:
+                    # 递归模式
+                    print(f"检查子目录：{savepath}/{share_file['file_name']}")
+                    subdir_tree = self.dir_check_and_save(
+                        task,
+                        pwd_id,
+                        stoken,
+                        share_file["fid"],
+                        f"{subdir_path}/{share_file['file_name']}",
+                        saves,
+                    )
+                    subdir_trees.append((share_file, subdir_tree))
+        # 重存的目录按分享列表中的顺序转存
+        share_index = {fid: i for i, fid in enumerate(share_fids)}
+        need_save_list.sort(key=lambda f: share_index[f["fid"]])
 
         if re.search(r"\{I+\}", replace):
             mr.set_dir_file_list(dir_file_list, replace)
@@ -1012,32 +2413,76 @@ class Quark:
         # 转存文件
         fid_list = [item["fid"] for item in need_save_list]
         fid_token_list = [item["share_fid_token"] for item in need_save_list]
-        if fid_list:
-            err_msg = None
-            save_as_top_fids = []
-            while fid_list:
-                # 分次转存，100个/次，因query_task返回save_as_top_fids最多100
-                save_file_return = self.save_file(
-                    fid_list[:100], fid_token_list[:100], to_pdir_fid, pwd_id, stoken
+        record = {
+            "task": task,
+            "tree": tree,
+            "pdir_fid": pdir_fid,
+            "savepath": savepath,
+            "need_save_list": need_save_list,
+            "subdir_trees": subdir_trees,
+            "task_ids": [],
+            "err_msg": None,
+        }
+        while fid_list:
+            # 分次转存，100个/次，因query_task返回save_as_top_fids最多100
+            save_file_return = self.save_file(
+                fid_list[:100], fid_token_list[:100], to_pdir_fid, pwd_id, stoken
+            )
+            fid_list = fid_list[100:]
+            fid_token_list = fid_token_list[100:]
+            if save_file_return["code"] == 0:
+                record["task_ids"].append(save_file_return["data"]["task_id"])
+            else:
+                record["err_msg"] = save_file_return["message"]
+                add_notify(f"❌《{task['taskname']}》转存失败：{record['err_msg']}\n")
+
+        def on_success():
+            # 转存无异常时记录分享列表、最新文件，供下次运行比对
+            if share_cache:
+                share_cache.put(
+                    self.path_cache_account,
+                    pwd_id,
+                    share_fid,
+                    cache_sign,
+                    share_detail,
+                    share_file_list,
                 )
-                fid_list = fid_list[100:]
-                fid_token_list = fid_token_list[100:]
-                if save_file_return["code"] == 0:
-                    # 转存成功，查询转存结果
-                    task_id = save_file_return["data"]["task_id"]
-                    query_task_return = self.query_task(task_id)
-                    if query_task_return["code"] == 0:
-                        save_as_top_fids.extend(
-                            query_task_return["data"]["save_as"]["save_as_top_fids"]
-                        )
-                    else:
-                        err_msg = query_task_return["message"]
+            if CONFIG_DATA.get("incremental_scan"):
+                if share_files := [f for f in share_file_list if not f["dir"]]:
+                    newest = max(share_files, key=lambda f: f["updated_at"])
+                    scan_marks[f"{pwd_id}/{share_fid}"] = {
+                        "fid": newest["fid"],
+                        "updated_at": newest["updated_at"],
+                        "sign": scan_sign,
+                    }
+
+        record["on_success"] = on_success
+        saves.append(record)
+        if own_saves:
+            self.finish_saves(saves)
+        return tree
+
+    def finish_saves(self, saves):
+        """统一等待已提交的转存任务，按提交顺序映射转存结果并建立目录树"""
+        task_ids = [task_id for record in saves for task_id in record["task_ids"]]
+        results = self.query_tasks(task_ids) if task_ids else {}
+        # 子目录的记录先于父目录，父目录合并时子目录树已建立
+        for record in saves:
+            task, tree, pdir_fid = record["task"], record["tree"], record["pdir_fid"]
+            need_save_list = record["need_save_list"]
+            err_msg = record["err_msg"]
+            save_as_top_fids = []
+            for task_id in record["task_ids"]:
+                query_task_return = results[task_id]
+                if query_task_return["code"] == 0:
+                    save_as_top_fids.extend(
+                        query_task_return["data"]["save_as"]["save_as_top_fids"]
+                    )
                 else:
-                    err_msg = save_file_return["message"]
-                if err_msg:
+                    err_msg = query_task_return["message"]
                     add_notify(f"❌《{task['taskname']}》转存失败：{err_msg}\n")
             # 建立目录树
-            if len(need_save_list) == len(save_as_top_fids):
+            if need_save_list and len(need_save_list) == len(save_as_top_fids):
                 for index, item in enumerate(need_save_list):
                     icon = self._get_file_icon(item)
                     tree.create_node(
@@ -1048,26 +2493,91 @@ class Quark:
                             "file_name": item["file_name"],
                             "file_name_re": item["file_name_re"],
                             "fid": f"{save_as_top_fids[index]}",
-                            "path": f"{savepath}/{item['file_name_re']}",
+                            "path": f"{record['savepath']}/{item['file_name_re']}",
                             "is_dir": item["dir"],
                             "obj_category": item.get("obj_category", ""),
                         },
                     )
-        return tree
+            for share_file, subdir_tree in record["subdir_trees"]:
+                if subdir_tree.size(1) > 0:
+                    # 合并子目录树
+                    tree.create_node(
+                        "📁" + share_file["file_name"],
+                        share_file["fid"],
+                        parent=pdir_fid,
+                        data={
+                            "is_dir": share_file["dir"],
+                        },
+                    )
+                    tree.merge(share_file["fid"], subdir_tree, deep=False)
+            if not err_msg:
+                record["on_success"]()
+        saves.clear()
+
+    def _rename_with_retry(self, fid, file_name):
+        """重命名单个文件，请求错误、限流时退避重试"""
+        for retry_index in range(self.RENAME_RETRIES + 1):
+            rename_ret = self.rename(fid, file_name)
+            with self._rename_lock:
+                self.rename_count += 1
+            if rename_ret.get("code") == 0 or not (
+                rename_ret.get("status", 200) >= 500 or rename_ret.get("status") == 429
+            ):
+                break
+            if retry_index < self.RENAME_RETRIES:
+                time.sleep(0.5 * 2**retry_index)
+        return rename_ret
 
-    def do_rename(self, tree, node_id=None):
+    def _rename_list(self, tree, node_id=None):
         if node_id is None:
             node_id = tree.root
+        rename_list = []
         for child in tree.children(node_id):
             file = child.data
             if file.get("is_dir"):
                 # self.do_rename(tree, child.identifier)
                 pass
             elif file.get("file_name_re") and file["file_name_re"] != file["file_name"]:
-                rename_ret = self.rename(file["fid"], file["file_name_re"])
-                print(f"重命名：{file['file_name']} → {file['file_name_re']}")
-                if rename_ret["code"] != 0:
-                    print(f"      ↑ 失败，{rename_ret['message']}")
+                rename_list.append(file)
+        return rename_list
+
+    def flush_renames(self, savepath=None):
+        """执行延迟的重命名，savepath 为空时执行全部"""
+        with self._rename_lock:
+            if savepath is None:
+                trees = [t for trees in self.pending_renames.values() for t in trees]
+                self.pending_renames.clear()
+            else:
+                trees = self.pending_renames.pop(savepath, [])
+        self._do_rename_list(
+            [file for tree in trees for file in self._rename_list(tree)]
+        )
+
+    def do_rename(self, tree, node_id=None):
+        self._do_rename_list(self._rename_list(tree, node_id))
+
+    def _do_rename_list(self, rename_list):
+        if not rename_list:
+            return
+        # 网盘无批量重命名接口，并发逐个重命名，按原顺序输出结果
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.RENAME_WORKERS, len(rename_list)))
+        ) as executor:
+            rename_rets = list(
+                executor.map(
+                    lambda file: self._rename_with_retry(
+                        file["fid"], file["file_name_re"]
+                    ),
+                    rename_list,
+                )
+            )
+        fail_count = 0
+        for file, rename_ret in zip(rename_list, rename_rets):
+            print(f"重命名：{file['file_name']} → {file['file_name_re']}")
+            if rename_ret["code"] != 0:
+                fail_count += 1
+                print(f"      ↑ 失败，{rename_ret['message']}")
+        print(f"重命名完成：成功 {len(rename_list) - fail_count}，失败 {fail_count}")
 
     def _get_file_icon(self, f):
         if f.get("dir"):
@@ -1150,13 +2660,142 @@ def do_sign(account):
     print()
 
 
-def do_save(account, tasklist=[]):
+def get_account(cookie, index=0):
+    """获取账号实例，进程内运行时复用实例的连接池与缓存"""
+    if WARM_ACCOUNTS is None:
+        return Quark(cookie, index)
+    if (cookie, index) not in WARM_ACCOUNTS:
+        WARM_ACCOUNTS[(cookie, index)] = Quark(cookie, index)
+    account = WARM_ACCOUNTS[(cookie, index)]
+    # 保存目录每次运行重新解析，持久化的路径缓存不受影响
+    account.savepath_fid = {"/": "0"}
+    account.task_pdir_fids = {}
+    return account
+
+
+def load_plugins(plugins_config):
+    """载入插件，进程内运行时插件配置不变则复用已初始化的插件"""
+    if WARM_PLUGINS is None:
+        return Config.load_plugins(plugins_config)
+    key = json.dumps(plugins_config, sort_keys=True)
+    with PLUGIN_LOCK:
+        if key not in WARM_PLUGINS:
+            WARM_PLUGINS.clear()
+            WARM_PLUGINS[key] = Config.load_plugins(copy.deepcopy(plugins_config))
+        plugins, plugins_config, task_plugins_config = WARM_PLUGINS[key]
+    return plugins, copy.deepcopy(plugins_config), copy.deepcopy(task_plugins_config)
+
+
+@functools.lru_cache(maxsize=None)
+def open_cache(cache_class, config_path, cache_config):
+    """按配置打开缓存，同一进程内复用数据库连接"""
+    return cache_class.from_config(config_path, json.loads(cache_config))
+
+
+def replace_tasklist(tasklist, new_tasklist):
+    """插件返回的任务列表写回配置，仅运行部分任务时按位置替换对应任务"""
+    config_tasklist = CONFIG_DATA.get("tasklist", [])
+    positions = {id(task): i for i, task in enumerate(config_tasklist)}
+    if (
+        tasklist is config_tasklist
+        or len(new_tasklist) != len(tasklist)
+        or not all(id(task) in positions for task in tasklist)
+    ):
+        return new_tasklist
+    config_tasklist = list(config_tasklist)
+    for task, new_task in zip(tasklist, new_tasklist):
+        config_tasklist[positions[id(task)]] = new_task
+    return config_tasklist
+
+
+def task_account_index(task):
+    """任务 account 字段指定的账号序号（从1开始），兼容数字字符串，未指定为 0，无效为 -1"""
+    try:
+        return int(task.get("account") or 0)
+    except (TypeError, ValueError):
+        return -1
+
+
+def task_accounts(accounts, tasklist):
+    """转存需要用到的账号：首个账号、任务指定的账号，自动分配时为全部账号"""
+    indexes = {0}
+    if CONFIG_DATA.get("account_balance"):
+        indexes = set(range(len(accounts)))
+    for task in tasklist:
+        index = task_account_index(task)
+        if 0 < index <= len(accounts):
+            indexes.add(index - 1)
+    return [accounts[i] for i in sorted(indexes)]
+
+
+def shard_tasks(accounts, tasklist):
+    """按账号划分任务，返回 {账号: 任务列表}
+
+    任务的 account 字段（从1开始）指定账号；未指定时使用首个账号。
+    开启 account_balance 时，未指定账号的任务分配到可用的账号：仅一个可用时直接使用，
+    否则优先分配到已存在保存目录的账号，再按本次任务最少、剩余空间最多分配，
+    并记录到任务中保持不变。
+    """
+    active = [account for account in accounts if account.is_active]
+    shards = {accounts[0]: []} if accounts[0].is_active else {}
+    unassigned = []
+    for task in tasklist:
+        index = task_account_index(task)
+        if not index:
+            unassigned.append(task)
+        elif 0 < index <= len(accounts) and accounts[index - 1].is_active:
+            shards.setdefault(accounts[index - 1], []).append(task)
+        else:
+            print(
+                f"跳过任务《{task['taskname']}》：指定的第{task['account']}个账号不可用"
+            )
+    if not CONFIG_DATA.get("account_balance"):
+        if accounts[0].is_active:
+            shards[accounts[0]].extend(unassigned)
+        elif unassigned:
+            print(f"跳过 {len(unassigned)} 个任务：第1个账号不可用")
+        return dict(sorted(shards.items(), key=lambda item: item[0].index))
+    if len(active) <= 1:
+        if active:
+            shards.setdefault(active[0], []).extend(unassigned)
+        elif unassigned:
+            print(f"跳过 {len(unassigned)} 个任务：没有可用的账号")
+        return dict(sorted(shards.items(), key=lambda item: item[0].index))
+    # 已存在保存目录的账号
+    savepaths = {re.sub(r"/{2,}", "/", f"/{task['savepath']}") for task in unassigned}
+    existing = {account: account.resolve_fids(savepaths) for account in active}
+    free_capacity = {}
+    for account in active:
+        growth_info = account.get_growth_info() if account.mparam else None
+        free_capacity[account] = (
+            growth_info.get("total_capacity", 0) - growth_info.get("use_capacity", 0)
+            if growth_info
+            else 0
+        )
+    for task in unassigned:
+        savepath = re.sub(r"/{2,}", "/", f"/{task['savepath']}")
+        account = next((a for a in active if savepath in existing[a]), None) or min(
+            active,
+            key=lambda a: (len(shards.get(a, [])), -free_capacity[a], a.index),
+        )
+        task["account"] = account.index
+        shards.setdefault(account, []).append(task)
+    return dict(sorted(shards.items(), key=lambda item: item[0].index))
+
+
+def do_save(account, tasklist=[], journal=None):
     print(f"🧩 载入插件")
-    plugins, CONFIG_DATA["plugins"], task_plugins_config = Config.load_plugins(
+    plugins, CONFIG_DATA["plugins"], task_plugins_config = load_plugins(
         CONFIG_DATA.get("plugins", {})
     )
     print()
     print(f"转存账号: {account.nickname}")
+    # 本次运行内复用目录列表
+    account.ls_dir_cache = {}
+    # 延迟重命名：全部任务转存完成后统一重命名，再调用插件
+    defer_rename = bool(CONFIG_DATA.get("deferred_rename"))
+    account.pending_renames = {} if defer_rename else None
+    account.rename_count = 0
     # 获取全部保存目录fid
     account.update_savepath_fid(tasklist)
 
@@ -1173,14 +2812,17 @@ def do_save(account, tasklist=[]):
             or (datetime.today().weekday() + 1 in task.get("runweek"))
         )
 
-    for plugin_name, plugin in plugins.items():
-        if plugin.is_active and hasattr(plugin, "task_before"):
-            tasklist = (
-                plugin.task_before(tasklist=tasklist, account=account) or tasklist
-            )
+    with PLUGIN_LOCK:
+        for plugin_name, plugin in plugins.items():
+            if plugin.is_active and hasattr(plugin, "task_before"):
+                tasklist = (
+                    plugin.task_before(tasklist=tasklist, account=account) or tasklist
+                )
 
-    # 执行任务
-    for index, task in enumerate(tasklist):
+    def savepath_of(task):
+        return re.sub(r"/{2,}", "/", f"/{task['savepath']}")
+
+    def run_task(index, task, pipe=None):
         print()
         print(f"#{index+1}------------------")
         print(f"任务名称: {task['taskname']}")
@@ -1197,57 +2839,203 @@ def do_save(account, tasklist=[]):
                 f"运行周期: WK{task.get('runweek',[])} ~ {task.get('enddate','forever')}"
             )
         print()
+        if journal and journal.is_done(task):
+            print(f"上次中断的运行中已完成，跳过")
+            return False, None
         # 判断任务周期
         if not is_time(task):
             print(f"任务不在运行周期内，跳过")
-        else:
-            is_new_tree = account.do_save_task(task)
-
-            # 补充任务的插件配置
-            def merge_dicts(a, b):
-                result = a.copy()
-                for key, value in b.items():
-                    if (
-                        key in result
-                        and isinstance(result[key], dict)
-                        and isinstance(value, dict)
-                    ):
-                        result[key] = merge_dicts(result[key], value)
-                    elif key not in result:
-                        result[key] = value
-                return result
-
-            task["addition"] = merge_dicts(
-                task.get("addition", {}), task_plugins_config
-            )
-            # 调用插件
-            if is_new_tree:
-                print(f"🧩 调用插件")
+            return False, None
+        # 同一保存路径有未完成的任务、重命名时先完成，保证目录列表与 {I} 序号正确
+        if pipe and savepath_of(task) in [
+            savepath_of(t) for _, t, _ in pipe["pending"]
+        ]:
+            flush_pipe(pipe)
+        if account.pending_renames and savepath_of(task) in account.pending_renames:
+            account.flush_renames(savepath_of(task))
+        with METRICS.task_timer(task["taskname"], "save"):
+            if pipe is None:
+                return True, account.do_save_task(task)
+            result = [True, account.do_save_task(task, pipe["saves"]), None]
+        if result[1] is not None:
+            pipe["pending"].append((index, task, result))
+        return result
+
+    def flush_pipe(pipe):
+        """统一等待已提交的转存，再依次完成各任务的重命名、通知，日志待按任务顺序输出"""
+        account.finish_saves(pipe["saves"])
+        for index, task, result in pipe["pending"]:
+
+            def finish_one():
+                print()
+                print(f"#{index+1}《{task['taskname']}》转存结果")
+                with METRICS.task_timer(task["taskname"], "finish"):
+                    return account.finish_save_task(task, result[1])
+
+            tree, error, output, notifys = run_captured(finish_one)
+            result[1], result[2] = tree, (error, output, notifys)
+        pipe["pending"].clear()
+
+    # 补充任务的插件配置
+    def merge_dicts(a, b):
+        result = a.copy()
+        for key, value in b.items():
+            if (
+                key in result
+                and isinstance(result[key], dict)
+                and isinstance(value, dict)
+            ):
+                result[key] = merge_dicts(result[key], value)
+            elif key not in result:
+                result[key] = value
+        return result
+
+    def run_plugins(task, is_new_tree):
+        task["addition"] = merge_dicts(task.get("addition", {}), task_plugins_config)
+        # 调用插件
+        if is_new_tree:
+            print(f"🧩 调用插件")
+            with PLUGIN_LOCK, METRICS.task_timer(task["taskname"], "plugins"):
                 for plugin_name, plugin in plugins.items():
                     if plugin.is_active and hasattr(plugin, "run"):
                         task = (
                             plugin.run(task, account=account, tree=is_new_tree) or task
                         )
+        # 任务完成，记录运行中变化的字段
+        if journal:
+            journal.record_task(task)
+
+    def emit_output(result):
+        if len(result) > 2 and result[2]:
+            error, output, notifys = result[2]
+            sys.stdout.write(output)
+            extend_notifys(notifys)
+            if error:
+                raise error
+
+    def finish_task(index, task, result):
+        is_run, is_new_tree = result[:2]
+        emit_output(result)
+        if is_run:
+            run_plugins(task, is_new_tree)
+
+    # 执行任务
+    max_workers = int(CONFIG_DATA.get("max_workers") or 1)
+    # 流水线转存：先提交全部任务的转存，再统一等待结果，最后依次重命名、通知、调用插件
+    pipeline = bool(CONFIG_DATA.get("pipeline_save"))
+    deferred = pipeline or defer_rename
+    results = []
+    pipes = []
+    stdout = sys.stdout
+    if not isinstance(stdout, TaskOutput):
+        sys.stdout = TaskOutput(stdout)
+    try:
+        if max_workers <= 1:
+            pipe = {"saves": [], "pending": []} if pipeline else None
+            pipes.append(pipe)
+            for index, task in enumerate(tasklist):
+                result = run_task(index, task, pipe)
+                if deferred:
+                    results.append(result)
+                else:
+                    finish_task(index, task, result)
+        else:
+            # 并发转存：同一保存路径的任务串行执行，保证 {I} 序号正确
+            groups = {}
+            for index, task in enumerate(tasklist):
+                groups.setdefault(savepath_of(task), []).append(index)
+            futures = [Future() for _ in tasklist]
+
+            def run_group(indexes):
+                pipe = {"saves": [], "pending": []} if pipeline else None
+                for index in indexes:
+                    futures[index].set_result(
+                        run_captured(run_task, index, tasklist[index], pipe)
+                    )
+                return pipe
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                group_futures = [
+                    executor.submit(run_group, indexes) for indexes in groups.values()
+                ]
+                # 按任务顺序输出日志、通知，插件在主线程中依次调用
+                for index, task in enumerate(tasklist):
+                    result, error, output, notifys = futures[index].result()
+                    sys.stdout.write(output)
+                    extend_notifys(notifys)
+                    if error:
+                        raise error
+                    if deferred:
+                        results.append(result)
+                    else:
+                        finish_task(index, task, result)
+                pipes = [future.result() for future in group_futures]
+        if pipeline:
+            print()
+            flush_pipe(
+                {
+                    "saves": [record for pipe in pipes for record in pipe["saves"]],
+                    "pending": sorted(
+                        (item for pipe in pipes for item in pipe["pending"]),
+                        key=lambda item: item[0],
+                    ),
+                }
+            )
+        if deferred:
+            for result in results:
+                emit_output(result)
+            if defer_rename and account.pending_renames:
+                print()
+                print(f"===============批量重命名===============")
+                account.flush_renames()
+            for index, task in enumerate(tasklist):
+                is_run, is_new_tree = results[index][:2]
+                if is_run:
+                    run_plugins(task, is_new_tree)
+    finally:
+        sys.stdout = stdout
+        account.pending_renames = None
+    if account.rename_count:
+        print()
+        print(f"🏷️ 重命名请求：{account.rename_count} 次")
     print()
     print(f"===============插件收尾===============")
-    for plugin_name, plugin in plugins.items():
-        if plugin.is_active and hasattr(plugin, "task_after"):
-            data = plugin.task_after(tasklist=tasklist, account=account)
-            if data.get("tasklist"):
-                CONFIG_DATA["tasklist"] = data["tasklist"]
-            if data.get("config"):
-                CONFIG_DATA["plugins"][plugin_name] = data["config"]
+    with PLUGIN_LOCK:
+        for plugin_name, plugin in plugins.items():
+            if plugin.is_active and hasattr(plugin, "task_after"):
+                data = plugin.task_after(tasklist=tasklist, account=account)
+                if data.get("tasklist"):
+                    CONFIG_DATA["tasklist"] = replace_tasklist(
+                        tasklist, data["tasklist"]
+                    )
+                    if journal:
+                        for task in data["tasklist"]:
+                            journal.record_task(task, done=False)
+                if data.get("config"):
+                    CONFIG_DATA["plugins"][plugin_name] = data["config"]
+                    if journal:
+                        journal.record_plugin(plugin_name, data["config"])
+    account.ls_dir_cache = None
     print()
 
 
-def main():
+def main(config_path=None, tasklist=None, task_indexes=None, sign=None):
     global CONFIG_DATA
     start_time = datetime.now()
+    metrics_since = METRICS.snapshot()
     print(f"===============程序开始===============")
     print(f"⏰ 执行时间: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
     print()
     # 读取启动参数
-    config_path = sys.argv[1] if len(sys.argv) > 1 else "quark_config.json"
+    from_argv = config_path is None
+    if from_argv:
+        args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+        config_path = args[0] if args else "quark_config.json"
+    # 分享列表缓存统计
+    if from_argv and "--cache-stats" in sys.argv:
+        share_cache = ShareCache.from_config(config_path, {"enable": True})
+        print(f"🗃️ 分享列表缓存: {json.dumps(share_cache.stats())}")
+        return
     # 推送测试
     if os.environ.get("QUARK_TEST", "").lower() == "true":
         print(f"===============通知测试===============")
@@ -1264,12 +3052,17 @@ def main():
             print()
         return
     # 从环境变量中获取 TASKLIST
-    tasklist_from_env = []
-    if tasklist_json := os.environ.get("TASKLIST"):
+    tasklist_from_env = tasklist or []
+    if tasklist is None and (tasklist_json := os.environ.get("TASKLIST")):
         try:
             tasklist_from_env = json.loads(tasklist_json)
         except Exception as e:
             print(f"从环境变量解析任务列表失败 {e}")
+    # 仅运行配置中指定序号的任务（WebUI 按任务独立计划调度）
+    if task_indexes is None and (run_tasks := os.environ.get("RUN_TASKS")) is not None:
+        task_indexes = [int(i) for i in run_tasks.split(",") if i.strip()]
+    if sign is None:
+        sign = os.environ.get("RUN_SIGN", "true").lower() != "false"
     # 检查本地文件是否存在，如果不存在就下载
     if not os.path.exists(config_path):
         if os.environ.get("QUARK_COOKIE"):
@@ -1287,6 +3080,8 @@ def main():
     else:
         print(f"⚙️ 正从 {config_path} 文件中读取配置")
         CONFIG_DATA = Config.read_json(config_path)
+        # 写回时只合并本次运行的改动，不覆盖运行期间 WebUI 等对配置的修改
+        config_base = copy.deepcopy(CONFIG_DATA)
         Config.breaking_change_update(CONFIG_DATA)
         cookie_val = CONFIG_DATA.get("cookie")
         cookie_form_file = True
@@ -1295,24 +3090,77 @@ def main():
     if not cookies:
         print("❌ cookie 未配置")
         return
-    accounts = [Quark(cookie, index) for index, cookie in enumerate(cookies)]
+    accounts = [get_account(cookie, index) for index, cookie in enumerate(cookies)]
+    for account in accounts:
+        account.limiter = RequestLimiter.from_config(
+            CONFIG_DATA.get("rate_limit"), account.limiter
+        )
+    # 运行日志：回放中断运行的记录，本次运行逐任务记录
+    journal = None
+    if cookie_form_file and not tasklist_from_env:
+        journal = RunJournal.from_config(config_path, CONFIG_DATA.get("run_journal"))
+    if journal:
+        if recovered := journal.recover(CONFIG_DATA):
+            print(f"♻️ 已恢复上次中断运行的 {recovered} 个任务记录")
+            Config.patch_json(config_path, config_base, CONFIG_DATA)
+            config_base = copy.deepcopy(CONFIG_DATA)
+        journal.start()
+    # 本次运行的任务
+    if tasklist_from_env:
+        run_tasklist = tasklist_from_env
+    elif task_indexes is not None:
+        tasklist = CONFIG_DATA.get("tasklist", [])
+        run_tasklist = [tasklist[i] for i in task_indexes if 0 <= i < len(tasklist)]
+    else:
+        run_tasklist = CONFIG_DATA.get("tasklist", [])
     # 签到
     print(f"===============签到任务===============")
-    if tasklist_from_env:
-        verify_account(accounts[0])
+    if tasklist_from_env or not sign:
+        for account in task_accounts(accounts, run_tasklist):
+            verify_account(account)
     else:
         for account in accounts:
             verify_account(account)
             do_sign(account)
     print()
     # 转存
-    if accounts[0].is_active and cookie_form_file:
+    if any(account.is_active for account in accounts) and cookie_form_file:
         print(f"===============转存任务===============")
-        # 任务列表
-        if tasklist_from_env:
-            do_save(accounts[0], tasklist_from_env)
+        for account in accounts:
+            account.share_cache = open_cache(
+                ShareCache, config_path, json.dumps(CONFIG_DATA.get("share_cache"))
+            )
+            account.path_cache = open_cache(
+                PathCache, config_path, json.dumps(CONFIG_DATA.get("path_cache"))
+            )
+        shards = shard_tasks(accounts, run_tasklist)
+        if len(shards) <= 1:
+            for account, tasklist in shards.items():
+                do_save(account, tasklist, journal)
         else:
-            do_save(accounts[0], CONFIG_DATA.get("tasklist", []))
+            # 多账号并行转存，各账号独立连接池，日志按账号顺序输出
+            stdout = sys.stdout
+            if not isinstance(stdout, TaskOutput):
+                sys.stdout = TaskOutput(stdout)
+            try:
+                with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                    futures = [
+                        executor.submit(
+                            run_captured, do_save, account, tasklist, journal
+                        )
+                        for account, tasklist in shards.items()
+                    ]
+                    errors = []
+                    for future in futures:
+                        _, error, output, notifys = future.result()
+                        sys.stdout.write(output)
+                        extend_notifys(notifys)
+                        if error:
+                            errors.append(error)
+            finally:
+                sys.stdout = stdout
+            if errors:
+                raise errors[0]
         print()
     # 通知
     if NOTIFYS:
@@ -1322,7 +3170,11 @@ def main():
         print()
     if cookie_form_file:
         # 更新配置
-        Config.write_json(config_path, CONFIG_DATA)
+        Config.patch_json(config_path, config_base, CONFIG_DATA)
+        if journal:
+            journal.end()
+        # 本次运行的接口统计
+        write_metrics(config_path, METRICS.summary(metrics_since), start_time)
 
     print(f"===============程序结束===============")
     duration = datetime.now() - start_time
@@ -1330,5 +3182,64 @@ def main():
     print()
 
 
+def write_metrics(config_path, summary, start_time):
+    """本次运行的接口统计写入配置目录 metrics.json，并输出耗时最多的接口"""
+    summary["start_time"] = start_time.strftime("%Y-%m-%d %H:%M:%S")
+    metrics_path = os.path.join(
+        os.path.dirname(os.path.abspath(config_path)), "metrics.json"
+    )
+    try:
+        with open(metrics_path, "w", encoding="utf-8") as file:
+            json.dump(summary, file, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"写入接口统计失败 {e}")
+    requests_count = sum(item["count"] for item in summary["requests"].values())
+    if requests_count:
+        print(f"📈 接口请求: {requests_count} 次")
+        top = sorted(summary["requests"].items(), key=lambda item: item[1]["seconds"])
+        for path, item in reversed(top[-3:]):
+            print(
+                f"   {path}: {item['count']} 次 / {item['seconds']}s / 平均 {item['avg_seconds']}s"
+            )
+        print()
+
+
+def run_in_process(
+    config_path,
+    tasklist=None,
+    output=None,
+    task_indexes=None,
+    sign=True,
+    timeout=-1,
+):
+    """在当前进程中执行一次运行，供 WebUI 常驻进程调用
+
+    账号连接池、插件实例与缓存在多次运行间复用；同一时间只执行一次运行，
+    等待进行中的运行超过 timeout 秒时跳过本次运行，返回 False。
+    output 为可写对象时本线程的输出写入其中。
+    """
+    global WARM_ACCOUNTS, WARM_PLUGINS
+    if not isinstance(sys.stdout, TaskOutput):
+        sys.stdout = TaskOutput(sys.stdout)
+    parent = getattr(TASK_LOCAL, "buffer", None)
+    TASK_LOCAL.buffer = output
+    try:
+        if not RUN_LOCK.acquire(blocking=False):
+            print(f"⏳ 已有运行中的任务，等待其结束")
+            if not RUN_LOCK.acquire(timeout=timeout):
+                print(f"❌ 等待超时，跳过本次运行")
+                return False
+        try:
+            if WARM_ACCOUNTS is None:
+                WARM_ACCOUNTS, WARM_PLUGINS = {}, {}
+            NOTIFYS.clear()
+            main(config_path, tasklist, task_indexes, sign)
+            return True
+        finally:
+            RUN_LOCK.release()
+    finally:
+        TASK_LOCAL.buffer = parent
+
+
 if __name__ == "__main__":
     main()